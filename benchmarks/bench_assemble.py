@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Benchmark ConcreteBytecode.to_code() on large code objects: assembling the
+instructions and the line number table. The stack size is computed once, it
+is not part of the measured time.
+
+Usage: python3 benchmarks/bench_assemble.py [loops]
+"""
+import sys
+import time
+
+from bytecode import ConcreteInstr, ConcreteBytecode
+
+
+SIZES = (10000, 50000)
+
+
+def create_bytecode(size):
+    # x = 0 + 1 + 2 + ... with a new line every 4 instructions, and
+    # arguments requiring EXTENDED_ARG
+    bytecode = ConcreteBytecode()
+    bytecode.consts = list(range(size))
+    bytecode.names = ['x']
+    instrs = [ConcreteInstr('LOAD_CONST', 0, lineno=1)]
+    for index in range(1, size):
+        lineno = 1 + index // 2
+        instrs.append(ConcreteInstr('LOAD_CONST', index, lineno=lineno))
+        instrs.append(ConcreteInstr('BINARY_ADD', lineno=lineno))
+    instrs.append(ConcreteInstr('STORE_NAME', 0, lineno=lineno))
+    instrs.append(ConcreteInstr('LOAD_CONST', 0, lineno=lineno))
+    instrs.append(ConcreteInstr('RETURN_VALUE', lineno=lineno))
+    bytecode.extend(instrs)
+    return bytecode
+
+
+def bench(bytecode, loops):
+    stacksize = bytecode.compute_stacksize()
+    best = None
+    for _ in range(loops):
+        start = time.process_time()
+        bytecode.to_code(stacksize=stacksize)
+        dt = time.process_time() - start
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main():
+    loops = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("best of %s runs" % loops)
+    for size in SIZES:
+        bytecode = create_bytecode(size)
+        dt = bench(bytecode, loops)
+        print("%s instructions: %.1f ms" % (len(bytecode), dt * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Benchmark Bytecode.to_concrete_bytecode() on module code using many distinct
+global names: the time per name should not depend on the number of names.
+
+Usage: python3 benchmarks/bench_names.py [loops]
+"""
+import sys
+import time
+
+from bytecode import Instr, Bytecode
+
+
+SIZES = (1000, 2000, 4000, 8000, 16000)
+
+
+def create_bytecode(size):
+    # x0 = y0; x1 = y1; ...
+    instrs = []
+    for index in range(size):
+        instrs.append(Instr('LOAD_NAME', 'y%s' % index))
+        instrs.append(Instr('STORE_NAME', 'x%s' % index))
+    instrs.append(Instr('LOAD_CONST', None))
+    instrs.append(Instr('RETURN_VALUE'))
+    return Bytecode(instrs)
+
+
+def bench(bytecode, loops):
+    best = None
+    for _ in range(loops):
+        start = time.process_time()
+        bytecode.to_concrete_bytecode()
+        dt = time.process_time() - start
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main():
+    loops = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print("best of %s runs" % loops)
+    for size in SIZES:
+        dt = bench(create_bytecode(size), loops)
+        print("%s names: %.1f ms (%.2f us per name)"
+              % (size * 2, dt * 1e3, dt * 1e6 / (size * 2)))
+
+
+if __name__ == "__main__":
+    main()
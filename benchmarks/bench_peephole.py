@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark PeepholeOptimizer.optimize() on a large generated module: the
+module code and the code of its functions. optimize_cfg() is also measured
+alone, without the conversions between code objects and control flow
+graphs.
+
+Usage: python3 benchmarks/bench_peephole.py [loops]
+"""
+import sys
+import time
+import types
+
+from bytecode import Bytecode, ControlFlowGraph
+from bytecode.peephole_opt import PeepholeOptimizer
+
+
+NFUNC = 300
+
+FUNC_TEMPLATE = """
+def func%(index)s(x, y, items):
+    total = %(index)s * 2 + 1
+    for item in items:
+        if item > x and not (item in y):
+            total += item.value - (3 - 1)
+        elif item is not None:
+            total -= len(item.name) << 2
+    while x:
+        x = x - 1
+        y = (y, x, 'abc')[0]
+    return total, [x, y, (1, 2, 3)], {'key': total}
+"""
+
+MODULE_TEMPLATE = """
+x%(index)s = %(index)s * 4 - 1
+y%(index)s = ('a', 'b')[%(index)s %% 2]
+"""
+
+
+def create_code():
+    source = []
+    for index in range(NFUNC):
+        source.append(FUNC_TEMPLATE % {'index': index})
+        source.append(MODULE_TEMPLATE % {'index': index})
+    return compile(''.join(source), '<generated>', 'exec')
+
+
+def iter_code(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from iter_code(const)
+
+
+def bench_optimize(codes, loops):
+    best = None
+    for _ in range(loops):
+        start = time.process_time()
+        for code in codes:
+            PeepholeOptimizer().optimize(code)
+        dt = time.process_time() - start
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def bench_optimize_cfg(codes, loops):
+    best = None
+    for _ in range(loops):
+        # the optimizer modifies the graphs in-place
+        cfgs = [ControlFlowGraph.from_bytecode(Bytecode.from_code(code))
+                for code in codes]
+        start = time.process_time()
+        for cfg in cfgs:
+            PeepholeOptimizer().optimize_cfg(cfg)
+        dt = time.process_time() - start
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def main():
+    loops = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    codes = list(iter_code(create_code()))
+    ninstr = sum(len(code.co_code) // 2 for code in codes)
+    print("%s code objects, %s instructions, best of %s runs"
+          % (len(codes), ninstr, loops))
+    print("optimize: %.1f ms" % (bench_optimize(codes, loops) * 1e3))
+    print("optimize_cfg: %.1f ms" % (bench_optimize_cfg(codes, loops) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
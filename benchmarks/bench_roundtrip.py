@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark the round trip of code objects of the standard library through
+Bytecode and ControlFlowGraph.
+
+Usage: python3 benchmarks/bench_roundtrip.py [loops]
+"""
+import sys
+import time
+import types
+
+from bytecode import Bytecode, ControlFlowGraph
+
+
+MODULES = ('argparse', 'difflib', 'json.decoder', 'pprint', 'textwrap',
+           'tokenize')
+
+
+def iter_code(code):
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            yield from iter_code(const)
+
+
+def get_codes():
+    codes = []
+    for name in MODULES:
+        module = __import__(name, fromlist=['*'])
+        with open(module.__file__, 'rb') as fp:
+            source = fp.read()
+        codes.extend(iter_code(compile(source, module.__file__, 'exec')))
+    return codes
+
+
+def bench(func, codes, loops):
+    best = None
+    for _ in range(loops):
+        start = time.process_time()
+        for code in codes:
+            func(code)
+        dt = time.process_time() - start
+        if best is None or dt < best:
+            best = dt
+    return best
+
+
+def bytecode_roundtrip(code):
+    return Bytecode.from_code(code).to_code()
+
+
+def cfg_roundtrip(code):
+    cfg = ControlFlowGraph.from_bytecode(Bytecode.from_code(code))
+    return cfg.to_code()
+
+
+def main():
+    loops = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    codes = get_codes()
+    print("%s code objects, best of %s runs" % (len(codes), loops))
+    for func in (bytecode_roundtrip, cfg_roundtrip):
+        print("%s: %.1f ms" % (func.__name__,
+                               bench(func, codes, loops) * 1e3))
+
+
+if __name__ == "__main__":
+    main()
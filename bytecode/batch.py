@@ -0,0 +1,176 @@
+"""
+Optimize the code objects of whole packages and write .pyc files.
+"""
+import argparse
+import collections
+import concurrent.futures
+import importlib.util
+import itertools
+import marshal
+import os
+import sys
+import types
+
+from bytecode.cache import _write_atomic
+from bytecode.peephole_opt import CodeTransformer, _transform_tree
+
+
+OptimizeResult = collections.namedtuple('OptimizeResult',
+                                        'filename pyc_filename error')
+
+# Size of the header of .pyc files: magic number, flags (Python 3.7 and
+# newer), and modification time and size of the source (or source hash)
+_PYC_HEADER_SIZE = 16 if sys.version_info >= (3, 7) else 12
+
+
+def _source_header(filename):
+    # Header of a .pyc file validated by the timestamp of the source, and
+    # mode of the source file
+    stat = os.stat(filename)
+    header = bytearray(importlib.util.MAGIC_NUMBER)
+    if sys.version_info >= (3, 7):
+        # flags of the PEP 552
+        header.extend((0).to_bytes(4, 'little'))
+    header.extend((int(stat.st_mtime) & 0xFFFFFFFF).to_bytes(4, 'little'))
+    header.extend((stat.st_size & 0xFFFFFFFF).to_bytes(4, 'little'))
+    return bytes(header), stat.st_mode
+
+
+def _read_pyc(filename):
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    header = data[:_PYC_HEADER_SIZE]
+    if (len(header) != _PYC_HEADER_SIZE
+            or header[:4] != importlib.util.MAGIC_NUMBER):
+        raise ValueError("%s: bad magic number" % filename)
+    code = marshal.loads(data[_PYC_HEADER_SIZE:])
+    if not isinstance(code, types.CodeType):
+        raise ValueError("%s does not contain a code object" % filename)
+    return header, code, os.stat(filename).st_mode
+
+
+def optimize_file(filename, transformer=None):
+    """Optimize a .py or .pyc file and write the optimized .pyc file.
+
+    All code objects are transformed once, including nested code objects:
+    a recursive transformer is only called on the module code object. The
+    .pyc file of a .py file is written into the __pycache__ directory, a
+    .pyc file is replaced. Return the filename of the written .pyc file.
+    """
+    if transformer is None:
+        transformer = CodeTransformer()
+
+    if filename.endswith('.pyc'):
+        pyc_filename = filename
+        header, code, mode = _read_pyc(filename)
+    else:
+        pyc_filename = importlib.util.cache_from_source(filename)
+        # get the timestamp before reading the source, as importlib
+        header, mode = _source_header(filename)
+        with open(filename, 'rb') as fp:
+            source = fp.read()
+        code = compile(source, filename, 'exec', dont_inherit=True)
+
+    if getattr(transformer, 'recursive', False):
+        # the transformer transforms the nested code objects itself
+        code = transformer.code_transformer(code, {})
+    else:
+        def transform(code):
+            return transformer.code_transformer(code, {})
+
+        code = _transform_tree(code, transform)
+    # the owner can write the .pyc file, as importlib
+    _write_atomic(pyc_filename, header + marshal.dumps(code),
+                  (mode | 0o200) & 0o666)
+    return pyc_filename
+
+
+def find_files(paths):
+    """Find the files to optimize in paths.
+
+    Directories are walked recursively: .py files are yielded, and .pyc
+    files without .py file in the same directory. __pycache__ directories
+    are skipped. Other paths are yielded as they are.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(name for name in dirnames
+                                 if name != '__pycache__')
+            names = set(filenames)
+            for name in sorted(filenames):
+                if (name.endswith('.py')
+                        or (name.endswith('.pyc') and name[:-1] not in names)):
+                    yield os.path.join(dirpath, name)
+
+
+def _optimize_file(filename, transformer):
+    try:
+        pyc_filename = optimize_file(filename, transformer)
+    except Exception as exc:
+        # syntax error, I/O error, or error of the transformer
+        return OptimizeResult(filename, None, exc)
+    return OptimizeResult(filename, pyc_filename, None)
+
+
+def optimize_files(paths, transformer=None, *, workers=None):
+    """Optimize the files of paths and write .pyc files.
+
+    Files are found by find_files() and optimized by optimize_file() in
+    worker processes: the transformer must be picklable. workers is the
+    number of processes, the number of CPUs by default.
+
+    Return a list of OptimizeResult, in the order of find_files(). An error
+    doesn't stop the optimization of other files.
+    """
+    if transformer is None:
+        transformer = CodeTransformer()
+    if workers is None:
+        workers = os.cpu_count() or 1
+    elif workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    filenames = list(find_files(paths))
+    if workers == 1 or len(filenames) <= 1:
+        return [_optimize_file(filename, transformer)
+                for filename in filenames]
+
+    # send files by chunks to limit the overhead of the inter-process
+    # communication
+    chunksize = max(len(filenames) // (workers * 4), 1)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(_optimize_file, filenames,
+                                 itertools.repeat(transformer),
+                                 chunksize=chunksize))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bytecode.peephole_opt',
+        description='Optimize the code objects of Python files with the '
+                    'peephole optimizer and write .pyc files.')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only display errors')
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='.py or .pyc file, or directory')
+    options = parser.parse_args(args)
+    if options.workers is not None and options.workers < 1:
+        parser.error("the number of workers must be at least 1")
+
+    results = optimize_files(options.paths, workers=options.workers)
+    errors = 0
+    for result in results:
+        if result.error is not None:
+            print("Error: %s: %s" % (result.filename, result.error),
+                  file=sys.stderr)
+            errors += 1
+    if not options.quiet:
+        print("Optimized %s files (%s errors)"
+              % (len(results) - errors, errors))
+    return 1 if errors else 0
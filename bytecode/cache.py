@@ -0,0 +1,307 @@
+"""
+Caches of decoded and transformed code objects.
+"""
+import collections
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+import tempfile
+import types
+
+import bytecode as _bytecode
+from bytecode import Label, SetLineno, Bytecode, ConcreteBytecode
+from bytecode.instr import const_key
+
+
+CacheInfo = collections.namedtuple('CacheInfo',
+                                   'hits misses maxsize currsize')
+
+
+def _code_key(code):
+    # Key of the content of a code object: two code objects with the same key
+    # are decoded to the same bytecode
+    key = (code.co_code, code.co_lnotab, const_key(code.co_consts),
+           code.co_names, code.co_varnames, code.co_freevars,
+           code.co_cellvars, code.co_argcount, code.co_kwonlyargcount,
+           code.co_flags, code.co_firstlineno, code.co_name,
+           code.co_filename)
+    if sys.version_info >= (3, 8):
+        key += (code.co_posonlyargcount,)
+    return key
+
+
+def _copy_instructions(instructions):
+    # Copy instructions and labels, the copy doesn't share any mutable object
+    # with the original
+    labels = collections.defaultdict(Label)
+    copy = []
+    for instr in instructions:
+        if isinstance(instr, Label):
+            instr = labels[instr]
+        elif not isinstance(instr, SetLineno):
+            instr = instr.copy()
+            if isinstance(instr.arg, Label):
+                instr._arg = labels[instr.arg]
+        copy.append(instr)
+    return copy
+
+
+def _copy_bytecode(bytecode):
+    copy = type(bytecode)()
+    # instructions are already checked: don't check them again
+    list.extend(copy, _copy_instructions(list.__iter__(bytecode)))
+    copy._copy_attr_from(bytecode)
+    # _copy_attr_from() shares lists
+    if isinstance(bytecode, ConcreteBytecode):
+        copy.consts = list(bytecode.consts)
+        copy.names = list(bytecode.names)
+        copy.varnames = list(bytecode.varnames)
+    else:
+        copy.argnames = list(bytecode.argnames)
+    return copy
+
+
+class CodeCache:
+    """LRU cache of the bytecode decoded from code objects.
+
+    Decoding the same code object twice returns a copy of the bytecode decoded
+    the first time, which is cheaper than decoding it again. Code objects are
+    first looked up by identity, then by content.
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # (kind, content key) => [bytecode, identifiers of the code objects]
+        self._entries = collections.OrderedDict()
+        # id(code) => (code, content key). Keep a reference to the code object
+        # to ensure that its identifier is not reused.
+        self._codes = {}
+
+    def _get(self, kind, code, decode):
+        try:
+            content_key = self._codes[id(code)][1]
+        except KeyError:
+            content_key = _code_key(code)
+        key = (kind, content_key)
+
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            bytecode = decode(code)
+            entry = [bytecode, set()]
+            self._entries[key] = entry
+            while len(self._entries) > self.maxsize:
+                self._evict()
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        entry[1].add(id(code))
+        self._codes[id(code)] = (code, content_key)
+        return _copy_bytecode(entry[0])
+
+    def _evict(self):
+        # remove the least recently used entry
+        key, entry = self._entries.popitem(last=False)
+        for code_id in entry[1]:
+            if self._codes.get(code_id, (None, None))[1] == key[1]:
+                del self._codes[code_id]
+
+    def concrete_from_code(self, code, *, extended_arg=False):
+        """Cached version of ConcreteBytecode.from_code()."""
+        return self._get(('concrete', extended_arg), code,
+                         lambda code: ConcreteBytecode.from_code(
+                             code, extended_arg=extended_arg))
+
+    def bytecode_from_code(self, code):
+        """Cached version of Bytecode.from_code()."""
+        return self._get('bytecode', code, Bytecode.from_code)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self._codes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+_CODE_ATTRS = ('co_argcount', 'co_kwonlyargcount', 'co_nlocals',
+               'co_stacksize', 'co_flags', 'co_code', 'co_consts',
+               'co_names', 'co_varnames', 'co_filename', 'co_name',
+               'co_firstlineno', 'co_lnotab', 'co_freevars', 'co_cellvars')
+if sys.version_info >= (3, 8):
+    _CODE_ATTRS += ('co_posonlyargcount',)
+
+# Types whose repr() identifies the value
+_REPR_TYPES = frozenset((type(None), type(Ellipsis), bool, int, float,
+                         complex, str, bytes))
+
+
+def _code_digest(code, digests):
+    # Digest of a code object. digests is None or a dict
+    # id(code) => (code, digest): nested code objects shared by several
+    # lookups are only serialized once.
+    if digests is not None:
+        try:
+            return digests[id(code)][1]
+        except KeyError:
+            pass
+
+    digest = hashlib.sha256()
+    for attr in _CODE_ATTRS:
+        _update_digest(digest, getattr(code, attr), digests)
+    code_digest = digest.digest()
+    if digests is not None:
+        # keep a reference to the code object to ensure that its identifier
+        # is not reused
+        digests[id(code)] = (code, code_digest)
+    return code_digest
+
+
+def _update_digest(digest, obj, digests=None):
+    # Feed a deterministic serialization of obj to digest. Unlike marshal,
+    # the result does not depend on reference counts.
+    obj_type = type(obj)
+    if obj_type in _REPR_TYPES:
+        data = repr(obj).encode('utf-8', 'surrogatepass')
+        digest.update(('%s:%s:' % (obj_type.__name__, len(data))).encode())
+        digest.update(data)
+    elif obj_type is tuple:
+        digest.update(b'(')
+        for item in obj:
+            _update_digest(digest, item, digests)
+        digest.update(b')')
+    elif obj_type is frozenset:
+        items = []
+        for item in obj:
+            item_digest = hashlib.sha256()
+            _update_digest(item_digest, item, digests)
+            items.append(item_digest.digest())
+        digest.update(b'{')
+        for item in sorted(items):
+            digest.update(item)
+        digest.update(b'}')
+    elif obj_type is types.CodeType:
+        digest.update(b'code:')
+        digest.update(_code_digest(obj, digests))
+    else:
+        raise TypeError("unsupported constant type: %s" % obj_type.__name__)
+
+
+def _write_atomic(path, data, mode=None):
+    # Write into a temporary file and then rename it, so that concurrent
+    # readers never see a partially written file. Create the directory if
+    # needed. The file is only readable by its owner if mode is None.
+    directory = os.path.dirname(path) or os.curdir
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with open(fd, 'wb') as fp:
+            fp.write(data)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TransformCache:
+    """Persistent cache of transformed code objects.
+
+    Transformed code objects are serialized with marshal into *directory*.
+    If *directory* is None, they are stored in the __pycache__ directory next
+    to the source file of the code object.
+
+    Entries are keyed by the content of the original code object, the
+    transformer identity and version, the Python version and magic number,
+    and the bytecode version: an entry is never used if one of them changes.
+    Entries are never removed: stale entries are left in the directory.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+    def _get_path(self, code, transformer_key, digests=None):
+        digest = hashlib.sha256()
+        try:
+            # the cache tag is not modified by changes of the magic number
+            # in pre-releases
+            _update_digest(digest, (sys.implementation.cache_tag,
+                                    importlib.util.MAGIC_NUMBER,
+                                    _bytecode.__version__,
+                                    transformer_key))
+            _update_digest(digest, code, digests)
+        except TypeError:
+            # a constant cannot be serialized
+            return None
+
+        directory = self.directory
+        if directory is None:
+            if not os.path.isfile(code.co_filename):
+                return None
+            directory = os.path.join(os.path.dirname(code.co_filename),
+                                     '__pycache__')
+        return os.path.join(directory, digest.hexdigest() + '.bytecode')
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as fp:
+                code = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            # missing or corrupted entry
+            return None
+        if not isinstance(code, types.CodeType):
+            return None
+        return code
+
+    def _store(self, path, code):
+        try:
+            data = marshal.dumps(code)
+        except ValueError:
+            # a constant cannot be marshalled
+            return
+
+        # The last writer wins, all writers store the same content
+        try:
+            _write_atomic(path, data)
+        except OSError:
+            # read-only directory, disk full, etc.: don't cache
+            pass
+
+    def transform(self, code, transformer, transformer_key, *, digests=None):
+        """Return transformer(code), loading the result from the cache.
+
+        *transformer_key* identifies the transformer and its version: it must
+        be changed when the transformer output changes.
+
+        *digests* is an optional dict caching the digests of code objects. It
+        can be shared by the calls transforming the code objects of a tree,
+        so nested code objects are only serialized once.
+        """
+        path = self._get_path(code, transformer_key, digests)
+        if path is None:
+            self.misses += 1
+            return transformer(code)
+
+        new_code = self._load(path)
+        if new_code is not None:
+            self.hits += 1
+            return new_code
+
+        self.misses += 1
+        new_code = transformer(code)
+        self._store(path, new_code)
+        return new_code
@@ -1,3 +1,5 @@
+import itertools
+
 # alias to keep the 'bytecode' variable free
 import bytecode as _bytecode
 from bytecode.concrete import ConcreteInstr
@@ -86,18 +88,32 @@ class BasicBlock(_bytecode._InstrList):
         return target_block
 
 
-def _compute_stack_size(block, size, maxsize):
+def _update_size(delta, size, maxsize):
+    size += delta
+    if size < 0:
+        msg = 'Failed to compute stacksize, got negative size'
+        raise RuntimeError(msg)
+    maxsize = max(maxsize, size)
+    return size, maxsize
 
-    if block.seen or block.startsize >= size:
-        return maxsize
 
-    def update_size(delta, size, maxsize):
-        size += delta
-        if size < 0:
-            msg = 'Failed to compute stacksize, got negative size'
-            raise RuntimeError(msg)
-        maxsize = max(maxsize, size)
-        return size, maxsize
+def _compute_stack_size(block, size, maxsize):
+    """Generator computing the stack size required by a block.
+
+    Instead of recursing into the blocks reachable from *block*, the
+    generator yields a ``(block, size, maxsize)`` tuple and expects to be
+    resumed with the updated maximum stack size once that block has been
+    processed. When the block is done, it yields its final maxsize as an int.
+
+    The driver loop lives in ControlFlowGraph.compute_stacksize(): it keeps an
+    explicit stack of suspended generators, so the depth of the CFG is not
+    limited by the Python recursion limit.
+    """
+    # A block is only revisited if it is reached with a larger starting size
+    # and it is not part of the current path (loop).
+    if block.seen or block.startsize >= size:
+        yield maxsize
+        return
 
     block.seen = True
     block.startsize = size
@@ -108,22 +124,23 @@ def _compute_stack_size(block, size, maxsize):
 
         if instr.has_jump():
             # first compute the taken-jump path
-            taken_size, maxsize = update_size(instr.stack_effect(jump=True),
-                                              size, maxsize)
-            maxsize = _compute_stack_size(instr.arg, taken_size, maxsize)
+            taken_size, maxsize = _update_size(instr.stack_effect(jump=True),
+                                               size, maxsize)
+            maxsize = yield (instr.arg, taken_size, maxsize)
 
             if instr.is_uncond_jump():
                 block.seen = False
-                return maxsize
+                yield maxsize
+                return
 
         # jump=False: non-taken path of jumps, or any non-jump
-        size, maxsize = update_size(instr.stack_effect(jump=False),
-                                    size, maxsize)
+        size, maxsize = _update_size(instr.stack_effect(jump=False),
+                                     size, maxsize)
     if block.next_block:
-        maxsize = _compute_stack_size(block.next_block, size, maxsize)
+        maxsize = yield (block.next_block, size, maxsize)
 
-    block.seen = 0
-    return maxsize
+    block.seen = False
+    yield maxsize
 
 
 class ControlFlowGraph(_bytecode.BaseBytecode):
@@ -131,7 +148,18 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
     def __init__(self):
         super().__init__()
         self._blocks = []
+        # id(block) => (block index, number of edits): the block index is
+        # valid before the edits of _block_edits[number of edits:]
         self._block_index = {}
+        # Insertions and deletions don't renumber the following blocks, but
+        # are logged as (start, delta) edits: the index of following blocks
+        # (index >= start) is moved by delta. get_block_index() applies
+        # edits lazily, the index is rebuilt when the log becomes too long.
+        self._block_edits = []
+        self._max_block_edits = 0
+        # id(block) => list of predecessor blocks, or None if it must be
+        # recomputed
+        self._predecessors = None
         self.argnames = []
 
         self.add_block()
@@ -144,22 +172,87 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
         for block in self._blocks:
             current_lineno = block.legalize(current_lineno)
 
+    def _rebuild_block_index(self):
+        blocks = self._blocks
+        self._block_index = dict(zip(map(id, blocks),
+                                     zip(itertools.count(),
+                                         itertools.repeat(0))))
+        self._block_edits.clear()
+        # rebuilding the index is O(n), applying an edit is O(1): rebuild it
+        # every O(sqrt(n)) edits
+        self._max_block_edits = max(int(4 * len(blocks) ** 0.5), 32)
+
+    def _add_block_edit(self, start, delta):
+        edits = self._block_edits
+        edits.append((start, delta))
+        if len(edits) > self._max_block_edits:
+            self._rebuild_block_index()
+
     def get_block_index(self, block):
         try:
-            return self._block_index[id(block)]
+            block_index, nedit = self._block_index[id(block)]
         except KeyError:
             raise ValueError("the block is not part of this bytecode")
 
+        edits = self._block_edits
+        if nedit != len(edits):
+            for start, delta in itertools.islice(edits, nedit, None):
+                if block_index >= start:
+                    block_index += delta
+            self._block_index[id(block)] = (block_index, len(edits))
+        return block_index
+
     def _add_block(self, block):
         block_index = len(self._blocks)
         self._blocks.append(block)
-        self._block_index[id(block)] = block_index
+        self._block_index[id(block)] = (block_index, len(self._block_edits))
+        self._predecessors = None
 
     def add_block(self, instructions=None):
         block = BasicBlock(instructions)
         self._add_block(block)
         return block
 
+    def get_successors(self, block):
+        """Get the blocks which can be executed after block.
+
+        Return the next block (fall-through) and the jump target.
+        """
+        successors = []
+        next_block = block.next_block
+        if next_block is not None:
+            successors.append(next_block)
+        target_block = block.get_jump()
+        if target_block is not None and target_block is not next_block:
+            successors.append(target_block)
+        return successors
+
+    def get_predecessors(self, block):
+        """Get the blocks which can be executed before block.
+
+        Predecessors of all blocks are computed at once in linear time and
+        cached. The cache is invalidated by add_block(), split_block() and
+        __delitem__(), but invalidate_edges() must be called after modifying
+        jumps or next_block of blocks in-place.
+        """
+        if self._predecessors is None:
+            predecessors = {id(block): [] for block in self._blocks}
+            for pred in self._blocks:
+                for succ in self.get_successors(pred):
+                    succ_preds = predecessors.get(id(succ))
+                    if succ_preds is not None:
+                        succ_preds.append(pred)
+            self._predecessors = predecessors
+
+        try:
+            return list(self._predecessors[id(block)])
+        except KeyError:
+            raise ValueError("the block is not part of this bytecode")
+
+    def invalidate_edges(self):
+        """Invalidate the predecessors cached by get_predecessors()."""
+        self._predecessors = None
+
     def compute_stacksize(self):
         if not self:
             return 0
@@ -168,7 +261,22 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
             block.seen = False
             block.startsize = -32768  # INT_MIN
 
-        return _compute_stack_size(self[0], 0, 0)
+        # Depth-first walk of the graph using an explicit stack of suspended
+        # generators rather than recursion
+        pending = []
+        gen = _compute_stack_size(self[0], 0, 0)
+        result = next(gen)
+        while True:
+            if isinstance(result, int):
+                # gen is done: resume its caller with the computed maxsize
+                if not pending:
+                    return result
+                gen = pending.pop()
+                result = gen.send(result)
+            else:
+                pending.append(gen)
+                gen = _compute_stack_size(*result)
+                result = next(gen)
 
     def __repr__(self):
         return '<ControlFlowGraph block#=%s>' % len(self._blocks)
@@ -224,11 +332,12 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
         if isinstance(index, BasicBlock):
             index = self.get_block_index(index)
         block = self._blocks[index]
+        if index < 0:
+            index += len(self._blocks)
         del self._blocks[index]
         del self._block_index[id(block)]
-        for index in range(index, len(self)):
-            block = self._blocks[index]
-            self._block_index[id(block)] -= 1
+        self._add_block_edit(index + 1, -1)
+        self._predecessors = None
 
     def split_block(self, block, index):
         if not isinstance(block, BasicBlock):
@@ -253,13 +362,14 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
         del block[index:]
 
         block2 = BasicBlock(instructions)
+        block2.next_block = block.next_block
         block.next_block = block2
 
-        for block in self[block_index + 1:]:
-            self._block_index[id(block)] += 1
-
         self._blocks.insert(block_index + 1, block2)
-        self._block_index[id(block2)] = block_index + 1
+        self._add_block_edit(block_index + 1, 1)
+        self._block_index[id(block2)] = (block_index + 1,
+                                         len(self._block_edits))
+        self._predecessors = None
 
         return block2
 
@@ -318,7 +428,7 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
 
         for instr in jumps:
             label = instr.arg
-            instr.arg = labels[label]
+            instr._arg = labels[label]
 
         return bytecode_blocks
 
@@ -351,7 +461,7 @@ class ControlFlowGraph(_bytecode.BaseBytecode):
 
         # Map to new labels
         for instr in jumps:
-            instr.arg = labels[id(instr.arg)]
+            instr._arg = labels[id(instr.arg)]
 
         bytecode = _bytecode.Bytecode()
         bytecode._copy_attr_from(self)
@@ -0,0 +1,292 @@
+"""
+Optimizations of control flow graphs using dataflow analysis.
+"""
+from bytecode.instr import Instr, SetLineno, const_key
+from bytecode.dataflow import Liveness, ReachingDefinitions
+
+
+# Functions and attributes giving access to the local variables of a frame:
+# optimizations of local variables are disabled if they are used
+_INTROSPECTION_NAMES = frozenset(('locals', 'vars', 'dir', 'eval', 'exec',
+                                  '_getframe', 'currentframe'))
+
+
+def _uses_introspection(cfg):
+    for block in cfg:
+        for instr in list.__iter__(block):
+            if (isinstance(instr, Instr)
+                    and instr.name in ('LOAD_GLOBAL', 'LOAD_NAME',
+                                       'LOAD_ATTR', 'LOAD_METHOD')
+                    and instr.arg in _INTROSPECTION_NAMES):
+                return True
+    return False
+
+
+def _deleted_variables(cfg):
+    deleted = set()
+    for block in cfg:
+        for instr in list.__iter__(block):
+            if isinstance(instr, Instr) and instr.name == 'DELETE_FAST':
+                deleted.add(instr.arg)
+    return deleted
+
+
+def _remove_useless_pops(block, bound_variables):
+    # Remove instructions without side effect followed by POP_TOP:
+    # "LOAD_CONST; POP_TOP", "DUP_TOP; POP_TOP" and "LOAD_FAST x; POP_TOP"
+    # if x is always bound. Return the number of removed pairs.
+    removed = 0
+    index = 0
+    while index < len(block) - 1:
+        instr = block[index]
+        next_instr = block[index + 1]
+        if (isinstance(instr, Instr) and isinstance(next_instr, Instr)
+                and next_instr.name == 'POP_TOP'
+                and (instr.name in ('LOAD_CONST', 'DUP_TOP')
+                     or (instr.name == 'LOAD_FAST'
+                         and instr.arg in bound_variables))):
+            del block[index:index + 2]
+            removed += 1
+            if index:
+                # DUP_TOP; DUP_TOP; POP_TOP; POP_TOP
+                index -= 1
+        else:
+            index += 1
+    return removed
+
+
+def _unbound_stores(cfg):
+    # Find the STORE_FAST instructions of variables which cannot hold a value
+    # before the store: all reaching definitions are DELETE_FAST or the
+    # unbound variable at the function entry. Removing a store overriding a
+    # value would change when the old value is released. Return a set of
+    # id(instr).
+    analysis = ReachingDefinitions(cfg).run()
+    argnames = set(cfg.argnames)
+    stores = set()
+    for block in cfg:
+        for index, instr, value in analysis.instr_values(block):
+            if instr.name != 'STORE_FAST':
+                continue
+            for definition in analysis.get_definitions(value, instr.arg):
+                if definition.instr is None:
+                    if instr.arg in argnames:
+                        break
+                elif definition.instr.name != 'DELETE_FAST':
+                    break
+            else:
+                stores.add(id(instr))
+    return stores
+
+
+def remove_dead_stores(cfg):
+    """Remove stores into fast local variables which are never read.
+
+    Replace "STORE_FAST x" with "POP_TOP" if x is not live after the
+    instruction and x cannot hold a value before the instruction, and then
+    remove "LOAD_CONST; POP_TOP" pairs. "LOAD_CONST None; STORE_FAST x" is
+    kept: it is used to release a reference. Variables which are no longer
+    used are removed from co_varnames when the CFG is converted to a code
+    object.
+
+    Code using locals(), vars(), dir(), eval(), exec() or frame objects is
+    not modified. Return the number of removed stores.
+    """
+    if _uses_introspection(cfg):
+        return 0
+
+    liveness = Liveness(cfg).run()
+    unbound_stores = _unbound_stores(cfg)
+    removed = 0
+    for block in cfg:
+        previous = None
+        for index, instr, live in liveness.instr_values(block):
+            if (instr.name == 'STORE_FAST'
+                    and not liveness.is_live(live, instr.arg)
+                    and id(instr) in unbound_stores
+                    and not (previous is not None
+                             and previous.name == 'LOAD_CONST'
+                             and previous.arg is None)):
+                block[index] = Instr('POP_TOP', lineno=instr.lineno)
+                removed += 1
+            previous = instr
+
+    if removed:
+        # arguments are always bound, unless deleted
+        bound_variables = set(cfg.argnames) - _deleted_variables(cfg)
+        for block in cfg:
+            _remove_useless_pops(block, bound_variables)
+    return removed
+
+
+def _pure_stack_effect(instr):
+    # (pops, pushes) of instructions which don't access the local variables
+    # (except LOAD_FAST) and only use the top of the stack, or None
+    name = instr.name
+    if name in ('LOAD_CONST', 'LOAD_FAST', 'LOAD_GLOBAL', 'LOAD_DEREF'):
+        return (0, 1)
+    if name == 'LOAD_ATTR' or name.startswith('UNARY_'):
+        return (1, 1)
+    if name == 'COMPARE_OP' or name.startswith('BINARY_'):
+        return (2, 1)
+    return None
+
+
+def _match_forward(instrs, index, live_after, liveness):
+    # Match "STORE_FAST x; LOAD_FAST x; <code>; LOAD_FAST x" at index where
+    # <code> replaces the top of the stack with a single value and x is not
+    # live after the last instruction. Return (end, code) or None.
+    store = instrs[index]
+    name = store.arg
+    if not (index + 1 < len(instrs)
+            and isinstance(instrs[index + 1], Instr)
+            and instrs[index + 1].name == 'LOAD_FAST'
+            and instrs[index + 1].arg == name):
+        return None
+    if not liveness.is_live(live_after[index + 1], name):
+        # STORE_FAST x; LOAD_FAST x
+        return (index + 2, None)
+
+    # number of values pushed on top of the stored value
+    depth = 0
+    end = index + 2
+    while end < len(instrs):
+        instr = instrs[end]
+        if not isinstance(instr, Instr):
+            return None
+        if instr.name == 'LOAD_FAST' and instr.arg == name:
+            break
+        effect = _pure_stack_effect(instr)
+        if effect is None:
+            return None
+        pops, pushes = effect
+        if pops > depth + 1:
+            # the stored value is not on the top of the stack
+            return None
+        depth += pushes - pops
+        end += 1
+    else:
+        return None
+
+    if depth != 0 or liveness.is_live(live_after[end], name):
+        return None
+    return (end + 1, instrs[index + 2:end])
+
+
+def forward_stores(cfg):
+    """Avoid storing temporary values into fast local variables.
+
+    If x is not live after the last LOAD_FAST, replace:
+
+    * "STORE_FAST x; LOAD_FAST x" with nothing
+    * "STORE_FAST x; LOAD_FAST x; LOAD_FAST x" with "DUP_TOP"
+    * "STORE_FAST x; LOAD_FAST x; <code>; LOAD_FAST x" with
+      "DUP_TOP; <code>; ROT_TWO" where <code> replaces the value on the top
+      of the stack with a single value, without side effect on x.
+
+    Only stores of variables which cannot hold a value before the store are
+    removed: overriding a value releases it.
+
+    Code using locals(), vars(), dir(), eval(), exec() or frame objects is
+    not modified. Return the number of removed stores.
+    """
+    if _uses_introspection(cfg):
+        return 0
+
+    liveness = Liveness(cfg).run()
+    unbound_stores = _unbound_stores(cfg)
+    removed = 0
+    for block in cfg:
+        instrs = list(list.__iter__(block))
+        live_after = [None] * len(instrs)
+        for index, instr, live in liveness.instr_values(block):
+            live_after[index] = live
+
+        new_instrs = []
+        modified = False
+        index = 0
+        while index < len(instrs):
+            instr = instrs[index]
+            match = None
+            if (isinstance(instr, Instr) and instr.name == 'STORE_FAST'
+                    and id(instr) in unbound_stores):
+                match = _match_forward(instrs, index, live_after, liveness)
+            if match is None:
+                new_instrs.append(instr)
+                index += 1
+                continue
+
+            end, code = match
+            lineno = instr.lineno
+            if code is not None:
+                new_instrs.append(Instr('DUP_TOP', lineno=lineno))
+                new_instrs.extend(code)
+                if code:
+                    new_instrs.append(Instr('ROT_TWO',
+                                            lineno=instrs[end - 1].lineno))
+            removed += 1
+            modified = True
+            index = end
+
+        if modified:
+            block[:] = new_instrs
+    return removed
+
+
+def _const_definitions(cfg):
+    # Find "LOAD_CONST value; STORE_FAST x": return a dict
+    # id(STORE_FAST instr) => value and the set of the stored variables
+    consts = {}
+    names = set()
+    for block in cfg:
+        previous = None
+        for instr in list.__iter__(block):
+            if isinstance(instr, SetLineno):
+                continue
+            if (instr.name == 'STORE_FAST' and previous is not None
+                    and previous.name == 'LOAD_CONST'):
+                consts[id(instr)] = previous.arg
+                names.add(instr.arg)
+            previous = instr
+    return consts, names
+
+
+def propagate_constants(cfg):
+    """Replace loads of fast local variables set to a constant.
+
+    Replace "LOAD_FAST x" with "LOAD_CONST value" if all definitions of x
+    reaching the instruction are "LOAD_CONST value; STORE_FAST x" with the
+    same constant, in any block. Arguments are never replaced.
+
+    Code using locals(), vars(), dir(), eval(), exec() or frame objects is
+    not modified. Return the number of replaced instructions.
+    """
+    consts, names = _const_definitions(cfg)
+    if not consts or _uses_introspection(cfg):
+        return 0
+
+    analysis = ReachingDefinitions(cfg).run()
+    replaced = 0
+    for block in cfg:
+        for index, instr, value in analysis.instr_values(block):
+            if instr.name != 'LOAD_FAST' or instr.arg not in names:
+                continue
+
+            key = None
+            for definition in analysis.get_definitions(value, instr.arg):
+                try:
+                    const = consts[id(definition.instr)]
+                except KeyError:
+                    # argument, unbound variable, DELETE_FAST or variable
+                    # not set to a constant
+                    break
+                if key is None:
+                    key = const_key(const)
+                elif const_key(const) != key:
+                    break
+            else:
+                if key is not None:
+                    block[index] = Instr('LOAD_CONST', const,
+                                         lineno=instr.lineno)
+                    replaced += 1
+    return replaced
@@ -1,5 +1,7 @@
+import bisect
 import dis
 import inspect
+import itertools
 import opcode as _opcode
 import struct
 import sys
@@ -9,11 +11,35 @@ import types
 import bytecode as _bytecode
 from bytecode.instr import (UNSET, Instr, Label, SetLineno,
                             FreeVar, CellVar, Compare,
-                            const_key, _check_arg_int)
+                            const_key, _check_arg_int,
+                            _OPCODE_FLAGS, _HAS_ARG, _HAS_JREL, _HAS_JABS,
+                            _HAS_CONST, _HAS_NAME, _HAS_LOCAL, _HAS_FREE,
+                            _HAS_COMPARE)
 
 _WORDCODE = (sys.version_info >= (3, 6))
 
 
+_OPCODES = frozenset(_opcode.opmap.values())
+
+
+if _WORDCODE:
+    def _iter_code(code):
+        # Each instruction is an opcode byte followed by an argument byte
+        return zip(range(0, len(code), 2), code[0::2], code[1::2])
+else:
+    def _iter_code(code):
+        offset = 0
+        while offset < len(code):
+            op = code[offset]
+            if op >= _opcode.HAVE_ARGUMENT:
+                arg = code[offset + 1] + code[offset + 2] * 256
+                yield (offset, op, arg)
+                offset += 3
+            else:
+                yield (offset, op, None)
+                offset += 1
+
+
 def _set_docstring(code, consts):
     if not consts:
         return
@@ -22,6 +48,26 @@ def _set_docstring(code, consts):
         code.docstring = first_const
 
 
+def _instr_size(arg, extended_args):
+    if _WORDCODE:
+        size = 2
+        if arg is not UNSET:
+            while arg > 0xff:
+                size += 2
+                arg >>= 8
+        if extended_args is not None:
+            size = 2 + 2 * extended_args
+    else:
+        size = 1
+        if arg is not UNSET:
+            size += 2
+            if arg > 0xffff:
+                size += 3
+            if extended_args is not None:
+                size = 1 + 3 * extended_args
+    return size
+
+
 class ConcreteInstr(Instr):
     """Concrete instruction.
 
@@ -40,7 +86,7 @@ class ConcreteInstr(Instr):
         self._set(name, arg, lineno)
 
     def _check_arg(self, name, opcode, arg):
-        if opcode >= _opcode.HAVE_ARGUMENT:
+        if _OPCODE_FLAGS[opcode] & _HAS_ARG:
             if arg is UNSET:
                 raise ValueError("operation %s requires an argument" % name)
 
@@ -49,25 +95,20 @@ class ConcreteInstr(Instr):
             if arg is not UNSET:
                 raise ValueError("operation %s has no argument" % name)
 
+    @classmethod
+    def _create(cls, opcode, arg=UNSET, lineno=None, extended_args=None):
+        instr = super()._create(opcode, arg, lineno)
+        instr._extended_args = extended_args
+        instr._size = _instr_size(arg, extended_args)
+        return instr
+
     def _set(self, name, arg, lineno):
         super()._set(name, arg, lineno)
-        if _WORDCODE:
-            size = 2
-            if arg is not UNSET:
-                while arg > 0xff:
-                    size += 2
-                    arg >>= 8
-            if self._extended_args is not None:
-                size = 2 + 2 * self._extended_args
-        else:
-            size = 1
-            if arg is not UNSET:
-                size += 2
-                if arg > 0xffff:
-                    size += 3
-                if self._extended_args is not None:
-                    size = 1 + 3 * self._extended_args
-        self._size = size
+        self._size = _instr_size(arg, self._extended_args)
+
+    def copy(self):
+        return self._create(self._opcode, self._arg, self._lineno,
+                            self._extended_args)
 
     @property
     def size(self):
@@ -77,9 +118,10 @@ class ConcreteInstr(Instr):
         return (self._lineno, self._name, self._arg)
 
     def get_jump_target(self, instr_offset):
-        if self._opcode in _opcode.hasjrel:
+        flags = _OPCODE_FLAGS[self._opcode]
+        if flags & _HAS_JREL:
             return instr_offset + self._size + self._arg
-        if self._opcode in _opcode.hasjabs:
+        if flags & _HAS_JABS:
             return self._arg
         return None
 
@@ -132,6 +174,11 @@ class ConcreteInstr(Instr):
         return cls(name, arg, lineno=lineno)
 
 
+_assemble_instr = ConcreteInstr.assemble
+_LNOTAB_MIN_LINENO = struct.pack('Bb', 0, -127)
+_LNOTAB_MAX_LINENO = struct.pack('Bb', 0, 126)
+
+
 class ConcreteBytecode(_bytecode._BaseBytecodeList):
 
     def __init__(self, instructions=(), *, consts=(), names=(), varnames=()):
@@ -186,61 +233,50 @@ class ConcreteBytecode(_bytecode._BaseBytecodeList):
     def from_code(code, *, extended_arg=False):
         line_starts = dict(dis.findlinestarts(code))
 
-        # find block starts
-        instructions = []
-        offset = 0
-        lineno = code.co_firstlineno
-        while offset < len(code.co_code):
-            if offset in line_starts:
-                lineno = line_starts[offset]
-
-            instr = ConcreteInstr.disassemble(lineno, code.co_code, offset)
-
-            instructions.append(instr)
-            offset += instr.size
-
-        # replace jump targets with blocks
+        # Decode all instructions in a single pass.
         # HINT : in some cases Python generate useless EXTENDED_ARG opcode
         # with a value of zero. Such opcodes do not increases the size of the
         # following opcode the way a normal EXTENDED_ARG does. As a
         # consequence, they need to be tracked manually as otherwise the
         # offsets in jump targets can end up being wrong.
-        if not extended_arg:
-            nb_extended_args = 0
-            extended_arg = None
-            index = 0
-            while index < len(instructions):
-                instr = instructions[index]
-
-                if instr.name == 'EXTENDED_ARG':
-                    nb_extended_args += 1
-                    if extended_arg is not None:
-                        if not _WORDCODE:
-                            raise ValueError("EXTENDED_ARG followed "
-                                             "by EXTENDED_ARG")
-                        extended_arg = (extended_arg << 8) + instr.arg
-                    else:
-                        extended_arg = instr.arg
-
-                    del instructions[index]
-                    continue
-
-                if extended_arg is not None:
-                    if _WORDCODE:
-                        arg = (extended_arg << 8) + instr.arg
-                    else:
-                        arg = (extended_arg << 16) + instr.arg
-                    extended_arg = None
+        create_instr = ConcreteInstr._create
+        instructions = []
+        lineno = code.co_firstlineno
+        ext_arg = None
+        nb_extended_args = 0
+        for offset, op, arg in _iter_code(code.co_code):
+            if offset in line_starts:
+                lineno = line_starts[offset]
 
-                    instr = ConcreteInstr(instr.name, arg, lineno=instr.lineno,
-                                          extended_args=nb_extended_args)
-                    instructions[index] = instr
-                    nb_extended_args = 0
+            if op not in _OPCODES:
+                raise ValueError("invalid operation name")
+            if not _OPCODE_FLAGS[op] & _HAS_ARG:
+                arg = UNSET
+
+            if op == _opcode.EXTENDED_ARG and not extended_arg:
+                # fold EXTENDED_ARG into the argument of the next instruction
+                nb_extended_args += 1
+                if ext_arg is not None:
+                    if not _WORDCODE:
+                        raise ValueError("EXTENDED_ARG followed "
+                                         "by EXTENDED_ARG")
+                    ext_arg = (ext_arg << 8) + arg
+                else:
+                    ext_arg = arg
+                continue
 
-                index += 1
+            if ext_arg is not None:
+                if arg is not UNSET:
+                    arg += ext_arg << (8 if _WORDCODE else 16)
+                instr = create_instr(op, arg, lineno, nb_extended_args)
+                ext_arg = None
+                nb_extended_args = 0
+            else:
+                instr = create_instr(op, arg, lineno)
+            instructions.append(instr)
 
-            if extended_arg is not None:
-                raise ValueError("EXTENDED_ARG at the end of the code")
+        if ext_arg is not None:
+            raise ValueError("EXTENDED_ARG at the end of the code")
 
         bytecode = ConcreteBytecode()
         bytecode.name = code.co_name
@@ -273,19 +309,58 @@ class ConcreteBytecode(_bytecode._BaseBytecodeList):
                 yield (lineno, instr)
 
     def _assemble_code(self):
-        offset = 0
-        code_str = []
+        # Write all instructions into a single buffer. Subclasses of
+        # ConcreteInstr overriding assemble() are still honored.
+        code = bytearray()
+        append = code.append
         linenos = []
-        for lineno, instr in self._normalize_lineno():
-            code_str.append(instr.assemble())
-            linenos.append((offset, lineno))
-            offset += instr.size
-        code_str = b''.join(code_str)
-        return (code_str, linenos)
+        offset = 0
+        lineno = self.first_lineno
+        prev_lineno = None
+        # Same as _normalize_lineno(), but each instruction is only checked
+        # once, and only line number changes are recorded.
+        for instr in list.__iter__(self):
+            if not isinstance(instr, ConcreteInstr):
+                self._check_instr(instr)
+            # if instr.lineno is not set, it's inherited from the previous
+            # instruction, or from self.first_lineno
+            if instr.lineno is not None:
+                lineno = instr.lineno
+            if isinstance(instr, SetLineno):
+                continue
+
+            if lineno != prev_lineno:
+                linenos.append((offset, lineno))
+                prev_lineno = lineno
+            size = instr._size
+            offset += size
+
+            if not _WORDCODE or type(instr).assemble is not _assemble_instr:
+                code += instr.assemble()
+                continue
+
+            arg = instr._arg
+            if arg is UNSET:
+                append(instr._opcode)
+                append(0)
+                continue
+
+            # Emit EXTENDED_ARG prefixes, most significant byte first. Add
+            # EXTENDED_ARG 0 prefixes if the size was forced by extended_args.
+            shift = 4 * (size - 2)
+            while (arg >> shift) > 0xff:
+                shift += 8
+            while shift:
+                append(_opcode.EXTENDED_ARG)
+                append((arg >> shift) & 0xff)
+                shift -= 8
+            append(instr._opcode)
+            append(arg & 0xff)
+        return (bytes(code), linenos)
 
     @staticmethod
     def _assemble_lnotab(first_lineno, linenos):
-        lnotab = []
+        lnotab = bytearray()
         old_offset = 0
         old_lineno = first_lineno
         for offset, lineno in linenos:
@@ -302,23 +377,24 @@ class ConcreteBytecode(_bytecode._BaseBytecodeList):
             old_offset = offset
 
             while doff > 255:
-                lnotab.append(b'\xff\x00')
+                lnotab += b'\xff\x00'
                 doff -= 255
 
             while dlineno < -127:
-                lnotab.append(struct.pack('Bb', 0, -127))
+                lnotab += _LNOTAB_MIN_LINENO
                 dlineno -= -127
 
             while dlineno > 126:
-                lnotab.append(struct.pack('Bb', 0, 126))
+                lnotab += _LNOTAB_MAX_LINENO
                 dlineno -= 126
 
             assert 0 <= doff <= 255
             assert -127 <= dlineno <= 126
 
-            lnotab.append(struct.pack('Bb', doff, dlineno))
+            lnotab.append(doff)
+            lnotab.append(dlineno & 0xff)
 
-        return b''.join(lnotab)
+        return bytes(lnotab)
 
     def compute_stacksize(self):
         bytecode = self.to_bytecode()
@@ -395,25 +471,26 @@ class ConcreteBytecode(_bytecode._BaseBytecodeList):
             size = instr.size
 
             arg = instr.arg
+            flags = _OPCODE_FLAGS[instr.opcode]
             # FIXME: better error reporting
-            if instr.opcode in _opcode.hasconst:
+            if flags & _HAS_CONST:
                 arg = self.consts[arg]
-            elif instr.opcode in _opcode.haslocal:
+            elif flags & _HAS_LOCAL:
                 arg = self.varnames[arg]
-            elif instr.opcode in _opcode.hasname:
+            elif flags & _HAS_NAME:
                 arg = self.names[arg]
-            elif instr.opcode in _opcode.hasfree:
+            elif flags & _HAS_FREE:
                 if arg < ncells:
                     name = self.cellvars[arg]
                     arg = CellVar(name)
                 else:
                     name = self.freevars[arg - ncells]
                     arg = FreeVar(name)
-            elif instr.opcode in _opcode.hascompare:
+            elif flags & _HAS_COMPARE:
                 arg = Compare(arg)
 
             if jump_target is None:
-                instr = Instr(instr.name, arg, lineno=lineno)
+                instr = Instr._create(instr.opcode, arg, lineno)
             else:
                 instr_index = len(instructions)
             instructions.append(instr)
@@ -427,7 +504,8 @@ class ConcreteBytecode(_bytecode._BaseBytecodeList):
             instr = instructions[index]
             # FIXME: better error reporting on missing label
             label = labels[jump_target]
-            instructions[index] = Instr(instr.name, label, lineno=instr.lineno)
+            instructions[index] = Instr._create(instr.opcode, label,
+                                                instr.lineno)
 
         bytecode = _bytecode.Bytecode()
         bytecode._copy_attr_from(self)
@@ -448,10 +526,6 @@ class ConcreteBytecode(_bytecode._BaseBytecodeList):
 
 class _ConvertBytecodeToConcrete:
 
-    # Default number of passes of compute_jumps() before giving up.  Refer to
-    # assemble_jump_offsets() in compile.c for background.
-    _compute_jumps_passes = 10
-
     def __init__(self, code):
         assert isinstance(code, _bytecode.Bytecode)
         self.bytecode = code
@@ -463,30 +537,55 @@ class _ConvertBytecodeToConcrete:
 
         # used to build ConcreteBytecode() object
         self.consts_indices = {}
+        self.consts_ids = {}
         self.consts_list = []
         self.names = []
+        self.names_indices = {}
         self.varnames = []
+        self.varnames_indices = {}
 
     def add_const(self, value):
+        # The same constant object is usually loaded many times: cache its
+        # index to avoid computing its key again. The constants are kept alive
+        # by the bytecode during the conversion, so their identifier is stable.
+        try:
+            return self.consts_ids[id(value)]
+        except KeyError:
+            pass
+
         key = const_key(value)
         if key in self.consts_indices:
-            return self.consts_indices[key]
-        index = len(self.consts_indices)
-        self.consts_indices[key] = index
-        self.consts_list.append(value)
+            index = self.consts_indices[key]
+        else:
+            index = len(self.consts_indices)
+            self.consts_indices[key] = index
+            self.consts_list.append(value)
+        self.consts_ids[id(value)] = index
         return index
 
     @staticmethod
-    def add(names, name):
+    def add(names, indices, name):
+        # indices maps a name to its index in the names list
         try:
-            index = names.index(name)
-        except ValueError:
+            return indices[name]
+        except KeyError:
             index = len(names)
             names.append(name)
-        return index
+            indices[name] = index
+            return index
+
+    @staticmethod
+    def _first_indices(names):
+        # like names.index(name), map a name to its first occurrence
+        indices = {}
+        for index, name in enumerate(names):
+            indices.setdefault(name, index)
+        return indices
 
     def concrete_instructions(self):
         ncells = len(self.bytecode.cellvars)
+        cellvars_indices = self._first_indices(self.bytecode.cellvars)
+        freevars_indices = self._first_indices(self.bytecode.freevars)
         lineno = self.bytecode.first_lineno
 
         for instr in self.bytecode:
@@ -507,79 +606,108 @@ class _ConvertBytecodeToConcrete:
                     lineno = instr.lineno
 
                 arg = instr.arg
+                flags = _OPCODE_FLAGS[instr.opcode]
                 is_jump = isinstance(arg, Label)
                 if is_jump:
                     label = arg
                     # fake value, real value is set in compute_jumps()
                     arg = 0
-                elif instr.opcode in _opcode.hasconst:
+                elif flags & _HAS_CONST:
                     arg = self.add_const(arg)
-                elif instr.opcode in _opcode.haslocal:
-                    arg = self.add(self.varnames, arg)
-                elif instr.opcode in _opcode.hasname:
-                    arg = self.add(self.names, arg)
-                elif instr.opcode in _opcode.hasfree:
+                elif flags & _HAS_LOCAL:
+                    arg = self.add(self.varnames, self.varnames_indices, arg)
+                elif flags & _HAS_NAME:
+                    arg = self.add(self.names, self.names_indices, arg)
+                elif flags & _HAS_FREE:
                     if isinstance(arg, CellVar):
-                        arg = self.bytecode.cellvars.index(arg.name)
+                        arg = cellvars_indices[arg.name]
                     else:
                         assert isinstance(arg, FreeVar)
-                        arg = ncells + self.bytecode.freevars.index(arg.name)
-                elif instr.opcode in _opcode.hascompare:
+                        arg = ncells + freevars_indices[arg.name]
+                elif flags & _HAS_COMPARE:
                     if isinstance(arg, Compare):
                         arg = arg.value
 
-                instr = ConcreteInstr(instr.name, arg, lineno=lineno)
+                instr = ConcreteInstr._create(instr.opcode, arg, lineno)
                 if is_jump:
                     self.jumps.append((len(self.instructions), label, instr))
 
             self.instructions.append(instr)
 
     def compute_jumps(self):
-        offsets = []
-        offset = 0
-        for index, instr in enumerate(self.instructions):
-            offsets.append(offset)
-            offset += instr.size
-        # needed if a label is at the end
-        offsets.append(offset)
+        """Resolve the labels of jump instructions to offsets.
 
-        # fix argument of jump instructions: resolve labels
-        modified = False
+        Jumps start with the smallest size and can only grow (EXTENDED_ARG),
+        so the relaxation always converges. After the first round, only the
+        jumps spanning an instruction which grew are computed again.
+        """
+        sizes = [instr.size for instr in self.instructions]
+
+        jumps = []
         for index, label, instr in self.jumps:
             target_index = self.labels[label]
-            target_offset = offsets[target_index]
+            relative = bool(_OPCODE_FLAGS[instr.opcode] & _HAS_JREL)
+            if relative:
+                # the argument depends on the size of instructions between
+                # the end of the jump and the target
+                span = (min(index + 1, target_index),
+                        max(index + 1, target_index))
+            else:
+                # the argument depends on the size of all instructions before
+                # the target
+                span = (0, target_index)
+            jumps.append((index, target_index, relative, span, instr))
+
+        args = {}
+        pending = jumps
+        while pending:
+            # offsets[index] is the offset of the index-th instruction
+            offsets = [0]
+            offsets.extend(itertools.accumulate(sizes))
+
+            grown = []
+            for index, target_index, relative, span, instr in pending:
+                arg = offsets[target_index]
+                if relative:
+                    arg -= offsets[index + 1]
+                args[index] = arg
+
+                size = _instr_size(arg, None)
+                if size > sizes[index]:
+                    sizes[index] = size
+                    grown.append(index)
+
+            if not grown:
+                break
+            grown.sort()
 
-            if instr.opcode in _opcode.hasjrel:
-                instr_offset = offsets[index]
-                target_offset -= (instr_offset + instr.size)
+            pending = []
+            for jump in jumps:
+                start, end = jump[3]
+                pos = bisect.bisect_left(grown, start)
+                if pos < len(grown) and grown[pos] < end:
+                    pending.append(jump)
 
-            old_size = instr.size
+        for index, target_index, relative, span, instr in jumps:
+            arg = args[index]
             # FIXME: better error report if target_offset is negative
-            instr.arg = target_offset
-            if instr.size != old_size:
-                modified = True
-
-        return modified
+            _check_arg_int(instr.name, arg)
+            instr._arg = arg
+            instr._size = sizes[index]
 
     def to_concrete_bytecode(self, compute_jumps_passes=None):
-        if compute_jumps_passes is None:
-            compute_jumps_passes = self._compute_jumps_passes
+        # compute_jumps_passes is ignored: compute_jumps() always converges.
+        # The parameter is kept for backward compatibility.
 
         first_const = self.bytecode.docstring
         if first_const is not UNSET:
             self.add_const(first_const)
 
         self.varnames.extend(self.bytecode.argnames)
+        self.varnames_indices = self._first_indices(self.varnames)
 
         self.concrete_instructions()
-        for pas in range(0, compute_jumps_passes):
-            modified = self.compute_jumps()
-            if not modified:
-                break
-        else:
-            raise RuntimeError("compute_jumps() failed to converge after"
-                               " %d passes"
-                               % (pas + 1))
+        self.compute_jumps()
 
         concrete = ConcreteBytecode(
             self.instructions,
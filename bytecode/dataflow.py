@@ -0,0 +1,474 @@
+"""
+Dataflow analysis on a control flow graph.
+"""
+import heapq
+
+from bytecode.instr import SetLineno
+
+
+# Instructions pushing a block on the block stack: their jump target is run
+# if an exception is raised (or on break for SETUP_LOOP) while the block is
+# on the stack
+_SETUP_NAMES = frozenset(('SETUP_LOOP', 'SETUP_EXCEPT', 'SETUP_FINALLY',
+                          'SETUP_WITH', 'SETUP_ASYNC_WITH'))
+
+# Maximum depth of the block stack (CO_MAXBLOCKS in CPython)
+_MAX_BLOCKS = 20
+
+
+class BitSetDomain:
+    """Map items to bits: a set of items is represented as an int bitset.
+
+    Items must be hashable.
+    """
+
+    def __init__(self, items=()):
+        # item => bit
+        self._bits = {}
+        self._items = []
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._bits
+
+    def add(self, item):
+        """Add an item if needed and return its bit."""
+        bit = self._bits.get(item)
+        if bit is None:
+            bit = 1 << len(self._items)
+            self._bits[item] = bit
+            self._items.append(item)
+        return bit
+
+    def bit(self, item):
+        return self._bits[item]
+
+    def to_bits(self, items):
+        bits = 0
+        for item in items:
+            bits |= self._bits[item]
+        return bits
+
+    def to_items(self, bits):
+        items = []
+        while bits:
+            low_bit = bits & -bits
+            items.append(self._items[low_bit.bit_length() - 1])
+            bits ^= low_bit
+        return items
+
+
+class _FlowGraph:
+    # Graph of the block indexes of a ControlFlowGraph
+
+    def __init__(self, cfg):
+        blocks = list(cfg)
+        self.blocks = blocks
+        block_index = {id(block): index for index, block in enumerate(blocks)}
+        # instructions of each block without SetLineno
+        self.instrs = [[instr for instr in list.__iter__(block)
+                        if not isinstance(instr, SetLineno)]
+                       for block in blocks]
+
+        # normal edges: fall-through and jumps
+        self.succs = [[block_index[id(succ)]
+                       for succ in cfg.get_successors(block)
+                       if id(succ) in block_index]
+                      for block in blocks]
+
+        # Exceptional edges: the target can be run after any instruction of
+        # the block, not only after its last instruction
+        self.exc_succs = self._exception_edges(block_index)
+
+        self.preds = [[] for _ in blocks]
+        self.exc_preds = [[] for _ in blocks]
+        for index in range(len(blocks)):
+            for succ in self.succs[index]:
+                self.preds[succ].append(index)
+            for succ in self.exc_succs[index]:
+                self.exc_preds[succ].append(index)
+
+        self.order = self._reverse_postorder()
+
+    def _exception_edges(self, block_index):
+        blocks = self.blocks
+        exc_succs = [set() for _ in blocks]
+
+        # (setup block index, handler block index)
+        setups = []
+        # Blocks where END_FINALLY can resume a break, continue or return
+        resume_targets = set()
+        finally_blocks = []
+        for index, block in enumerate(blocks):
+            instrs = self.instrs[index]
+            if any(instr.name == 'END_FINALLY' for instr in instrs):
+                finally_blocks.append(index)
+            if not instrs:
+                continue
+
+            last_instr = instrs[-1]
+            name = last_instr.name
+            target = block.get_jump()
+            if target is not None and id(target) in block_index:
+                target = block_index[id(target)]
+                if name in _SETUP_NAMES:
+                    setups.append((index, target))
+                if name in ('SETUP_LOOP', 'CONTINUE_LOOP'):
+                    resume_targets.add(target)
+            if (name == 'CALL_FINALLY' and block.next_block is not None
+                    and id(block.next_block) in block_index):
+                resume_targets.add(block_index[id(block.next_block)])
+
+        for index, handler in setups:
+            next_block = blocks[index].next_block
+            if next_block is None or id(next_block) not in block_index:
+                continue
+            for protected in self._protected_blocks(
+                    block_index[id(next_block)], block_index):
+                exc_succs[protected].add(handler)
+
+        for index in finally_blocks:
+            exc_succs[index] |= resume_targets
+        return [sorted(targets) for targets in exc_succs]
+
+    def _protected_blocks(self, start, block_index):
+        # Blocks reachable from start before the block pushed by the setup
+        # instruction is popped: track the depth of the block stack relative
+        # to the setup block. The result is an over-approximation.
+        blocks = self.blocks
+        protected = set()
+        seen = set()
+        pending = [(start, 0)]
+        while pending:
+            index, depth = pending.pop()
+            if (index, depth) in seen:
+                continue
+            seen.add((index, depth))
+            protected.add(index)
+
+            block = blocks[index]
+            for instr in self.instrs[index]:
+                if instr.name == 'POP_BLOCK':
+                    depth -= 1
+                    if depth < 0:
+                        break
+            else:
+                target = block.get_jump()
+                is_setup = (target is not None
+                            and block[-1].name in _SETUP_NAMES)
+                for succ in self.succs[index]:
+                    succ_depth = depth
+                    if is_setup and blocks[succ] is not target:
+                        # fall-through after a setup: a block was pushed
+                        succ_depth = min(depth + 1, _MAX_BLOCKS)
+                    pending.append((succ, succ_depth))
+        return protected
+
+    def _reverse_postorder(self):
+        nblock = len(self.blocks)
+        if not nblock:
+            return []
+
+        visited = [False] * nblock
+        postorder = []
+        visited[0] = True
+        pending = [(0, iter(self.succs[0] + self.exc_succs[0]))]
+        while pending:
+            index, succs = pending[-1]
+            for succ in succs:
+                if not visited[succ]:
+                    visited[succ] = True
+                    pending.append((succ, iter(self.succs[succ]
+                                               + self.exc_succs[succ])))
+                    break
+            else:
+                pending.pop()
+                postorder.append(index)
+
+        order = postorder[::-1]
+        # unreachable blocks
+        order.extend(index for index in range(nblock) if not visited[index])
+        return order
+
+
+class DataFlowAnalysis:
+    """Worklist-driven dataflow analysis on a ControlFlowGraph.
+
+    Subclasses define the direction of the analysis (forward attribute), the
+    lattice (bottom(), boundary() and join() methods) and the transfer
+    function of an instruction (transfer() method). The default lattice is
+    the lattice of sets represented as int bitsets (see BitSetDomain), join
+    is the union.
+
+    Forward analyses process blocks in reverse postorder, backward analyses
+    in postorder. Handlers of exceptions (and finally blocks) are considered
+    reachable from any instruction of the blocks that they protect.
+    """
+
+    # Forward or backward analysis?
+    forward = True
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._graph = None
+        self._in_values = None
+        self._out_values = None
+        self._block_index = None
+
+    def bottom(self):
+        """Initial value: the smallest value of the lattice."""
+        return 0
+
+    def boundary(self):
+        """Value at the entry of the CFG (forward analysis) or at the exit
+        of blocks without successor (backward analysis)."""
+        return self.bottom()
+
+    def join(self, value1, value2):
+        return value1 | value2
+
+    def transfer(self, instr, value):
+        """Compute the value after instr from the value before instr
+        (forward analysis), or the value before instr from the value after
+        instr (backward analysis)."""
+        raise NotImplementedError
+
+    def _join_values(self, value, values, indexes):
+        for index in indexes:
+            value = self.join(value, values[index])
+        return value
+
+    def run(self):
+        """Run the analysis until a fixed point is reached."""
+        graph = _FlowGraph(self.cfg)
+        nblock = len(graph.blocks)
+        self._graph = graph
+        self._block_index = {id(block): index
+                             for index, block in enumerate(graph.blocks)}
+        self._in_values = in_values = [self.bottom()] * nblock
+        self._out_values = out_values = [self.bottom()] * nblock
+        if not nblock:
+            return self
+
+        order = graph.order
+        if not self.forward:
+            order = order[::-1]
+        position = [0] * nblock
+        for pos, index in enumerate(order):
+            position[index] = pos
+
+        # process all blocks at least once
+        queue = list(range(nblock))
+        queued = [True] * nblock
+        if self.forward:
+            in_values[order[0]] = self.boundary()
+
+        transfer = self.transfer
+        join = self.join
+        while queue:
+            index = order[heapq.heappop(queue)]
+            queued[index] = False
+            instrs = graph.instrs[index]
+            exc_succs = graph.exc_succs[index]
+
+            if self.forward:
+                value = in_values[index]
+                exc_value = value
+                for instr in instrs:
+                    value = transfer(instr, value)
+                    if exc_succs:
+                        exc_value = join(exc_value, value)
+                out_values[index] = value
+
+                updates = [(succ, value) for succ in graph.succs[index]]
+                updates.extend((succ, exc_value) for succ in exc_succs)
+                for succ, value in updates:
+                    new_value = join(in_values[succ], value)
+                    if new_value != in_values[succ]:
+                        in_values[succ] = new_value
+                        if not queued[succ]:
+                            queued[succ] = True
+                            heapq.heappush(queue, position[succ])
+            else:
+                if graph.succs[index]:
+                    value = self._join_values(self.bottom(), in_values,
+                                              graph.succs[index])
+                else:
+                    value = self.boundary()
+                out_values[index] = value
+                exc_value = self._join_values(self.bottom(), in_values,
+                                              exc_succs)
+                if exc_succs:
+                    value = join(value, exc_value)
+                for instr in reversed(instrs):
+                    value = transfer(instr, value)
+                    if exc_succs:
+                        value = join(value, exc_value)
+
+                if value != in_values[index]:
+                    in_values[index] = value
+                    for pred in graph.preds[index] + graph.exc_preds[index]:
+                        if not queued[pred]:
+                            queued[pred] = True
+                            heapq.heappush(queue, position[pred])
+        return self
+
+    def _get_index(self, block):
+        if self._block_index is None:
+            raise RuntimeError("the analysis was not run")
+        try:
+            return self._block_index[id(block)]
+        except KeyError:
+            raise ValueError("the block is not part of the analyzed CFG")
+
+    def get_in(self, block):
+        """Get the value at the entry of a block."""
+        return self._in_values[self._get_index(block)]
+
+    def get_out(self, block):
+        """Get the value at the exit of a block."""
+        return self._out_values[self._get_index(block)]
+
+    def instr_values(self, block):
+        """Get the value before each instruction (forward analysis) or after
+        each instruction (backward analysis) of a block.
+
+        Return a list of (index, instr, value) tuples in the order of the
+        block, where index is the index of instr in the block. SetLineno are
+        skipped.
+        """
+        index = self._get_index(block)
+        graph = self._graph
+        exc_succs = graph.exc_succs[index]
+        values = []
+        if self.forward:
+            value = self._in_values[index]
+            for instr_index, instr in enumerate(block):
+                if isinstance(instr, SetLineno):
+                    continue
+                values.append((instr_index, instr, value))
+                value = self.transfer(instr, value)
+        else:
+            value = self._out_values[index]
+            exc_value = self._join_values(self.bottom(), self._in_values,
+                                          exc_succs)
+            if exc_succs:
+                value = self.join(value, exc_value)
+            for instr_index in range(len(block) - 1, -1, -1):
+                instr = block[instr_index]
+                if isinstance(instr, SetLineno):
+                    continue
+                values.append((instr_index, instr, value))
+                value = self.transfer(instr, value)
+                if exc_succs:
+                    value = self.join(value, exc_value)
+            values.reverse()
+        return values
+
+
+class Liveness(DataFlowAnalysis):
+    """Liveness of the fast local variables.
+
+    A variable is live if its value can be read before being overridden:
+    LOAD_FAST and DELETE_FAST read a variable (DELETE_FAST fails if the
+    variable is unbound), STORE_FAST overrides it. Values are bitsets of
+    the variables domain.
+    """
+
+    forward = False
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.variables = BitSetDomain()
+        for block in cfg:
+            for instr in list.__iter__(block):
+                if (not isinstance(instr, SetLineno)
+                        and instr.name in ('LOAD_FAST', 'STORE_FAST',
+                                           'DELETE_FAST')):
+                    self.variables.add(instr.arg)
+
+    def transfer(self, instr, live):
+        name = instr.name
+        if name == 'STORE_FAST':
+            return live & ~self.variables.bit(instr.arg)
+        if name in ('LOAD_FAST', 'DELETE_FAST'):
+            return live | self.variables.bit(instr.arg)
+        return live
+
+    def is_live(self, value, name):
+        bit = self.variables._bits.get(name)
+        return bit is not None and bool(value & bit)
+
+
+class Definition:
+    """Definition of a fast local variable.
+
+    instr is the STORE_FAST or DELETE_FAST instruction of the block, or None
+    for the value of the variable at the function entry: an argument or an
+    unbound variable.
+    """
+
+    __slots__ = ('name', 'block', 'instr')
+
+    def __init__(self, name, block=None, instr=None):
+        self.name = name
+        self.block = block
+        self.instr = instr
+
+    def __repr__(self):
+        if self.instr is None:
+            return '<Definition %r at entry>' % self.name
+        return '<Definition %r: %r>' % (self.name, self.instr)
+
+
+class ReachingDefinitions(DataFlowAnalysis):
+    """Reaching definitions of the fast local variables.
+
+    Values are bitsets of the definitions domain (Definition objects).
+    """
+
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.definitions = BitSetDomain()
+        # variable name => bits of all definitions of the variable
+        self._var_bits = {}
+        # id(instr) => bit of the definition
+        self._instr_bits = {}
+        self._entry_bits = 0
+
+        for block in cfg:
+            for instr in list.__iter__(block):
+                if isinstance(instr, SetLineno):
+                    continue
+                name = instr.name
+                if name in ('STORE_FAST', 'DELETE_FAST'):
+                    definition = Definition(instr.arg, block, instr)
+                    bit = self.definitions.add(definition)
+                    self._instr_bits[id(instr)] = bit
+                    self._add_var_bit(instr.arg, bit)
+                elif name == 'LOAD_FAST':
+                    self._add_var_bit(instr.arg, 0)
+
+    def _add_var_bit(self, name, bit):
+        if name not in self._var_bits:
+            entry_bit = self.definitions.add(Definition(name))
+            self._entry_bits |= entry_bit
+            self._var_bits[name] = entry_bit
+        self._var_bits[name] |= bit
+
+    def boundary(self):
+        return self._entry_bits
+
+    def transfer(self, instr, value):
+        if instr.name in ('STORE_FAST', 'DELETE_FAST'):
+            return ((value & ~self._var_bits[instr.arg])
+                    | self._instr_bits[id(instr)])
+        return value
+
+    def get_definitions(self, value, name):
+        """Get the definitions of a variable in value."""
+        return self.definitions.to_items(value & self._var_bits.get(name, 0))
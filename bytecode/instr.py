@@ -1,6 +1,7 @@
 import enum
 import dis
 import opcode as _opcode
+import struct
 import sys
 from marshal import dumps as _dumps
 
@@ -25,13 +26,78 @@ class Compare(enum.IntEnum):
 UNSET = object()
 
 
+# Opcode properties: bit flags precomputed once for the 256 possible opcodes
+# to avoid membership tests on the lists of the opcode module on hot paths
+_HAS_ARG = 0x001
+_HAS_JREL = 0x002
+_HAS_JABS = 0x004
+_HAS_JUMP = _HAS_JREL | _HAS_JABS
+_HAS_CONST = 0x008
+_HAS_NAME = 0x010
+_HAS_LOCAL = 0x020
+_HAS_FREE = 0x040
+_HAS_COMPARE = 0x080
+_IS_COND_JUMP = 0x100
+_IS_UNCOND_JUMP = 0x200
+_IS_FINAL = 0x400
+
+
+def _opcode_flags(op):
+    name = _opcode.opname[op]
+    flags = 0
+    if op >= _opcode.HAVE_ARGUMENT:
+        flags |= _HAS_ARG
+    for opcodes, flag in ((_opcode.hasjrel, _HAS_JREL),
+                          (_opcode.hasjabs, _HAS_JABS),
+                          (_opcode.hasconst, _HAS_CONST),
+                          (_opcode.hasname, _HAS_NAME),
+                          (_opcode.haslocal, _HAS_LOCAL),
+                          (_opcode.hasfree, _HAS_FREE),
+                          (_opcode.hascompare, _HAS_COMPARE)):
+        if op in opcodes:
+            flags |= flag
+    # Ex: POP_JUMP_IF_TRUE, JUMP_IF_FALSE_OR_POP
+    if 'JUMP_IF_' in name:
+        flags |= _IS_COND_JUMP
+    if name in {'JUMP_FORWARD', 'JUMP_ABSOLUTE'}:
+        flags |= _IS_UNCOND_JUMP | _IS_FINAL
+    if name in {'RETURN_VALUE', 'RAISE_VARARGS',
+                'BREAK_LOOP', 'CONTINUE_LOOP'}:
+        flags |= _IS_FINAL
+    return flags
+
+
+_OPCODE_FLAGS = tuple(_opcode_flags(op) for op in range(256))
+
+
+# Types for which two constants are equal if and only if they have the same
+# type and compare equal
+_SIMPLE_CONST_TYPES = frozenset((type(None), type(Ellipsis),
+                                 bool, int, str, bytes))
+
+_pack_float = struct.Struct('<d').pack
+
+
 def const_key(obj):
+    obj_type = type(obj)
+    if obj_type in _SIMPLE_CONST_TYPES:
+        return (obj_type, obj)
+    # Use the binary representation of floats to distinguish -0.0 from 0.0
+    if obj_type is float:
+        return (obj_type, _pack_float(obj))
+    if obj_type is complex:
+        return (obj_type, _pack_float(obj.real), _pack_float(obj.imag))
+    if obj_type is tuple:
+        return (obj_type, tuple(map(const_key, obj)))
+    if obj_type is frozenset:
+        return (obj_type, frozenset(map(const_key, obj)))
+
     try:
         return _dumps(obj)
     except ValueError:
         # For other types, we use the object identifier as an unique identifier
         # to ensure that they are seen as unequal.
-        return (type(obj), id(obj))
+        return (obj_type, id(obj))
 
 
 def _check_lineno(lineno):
@@ -136,34 +202,48 @@ class Instr:
     def __init__(self, name, arg=UNSET, *, lineno=None):
         self._set(name, arg, lineno)
 
+    @classmethod
+    def _create(cls, opcode, arg=UNSET, lineno=None):
+        """Create an instruction without validating its attributes.
+
+        Only used internally when the attributes are known to be valid, for
+        example when copying an existing instruction.
+        """
+        instr = cls.__new__(cls)
+        instr._name = _opcode.opname[opcode]
+        instr._opcode = opcode
+        instr._arg = arg
+        instr._lineno = lineno
+        return instr
+
     def _check_arg(self, name, opcode, arg):
-        if opcode >= _opcode.HAVE_ARGUMENT:
+        flags = _OPCODE_FLAGS[opcode]
+        if flags & _HAS_ARG:
             if arg is UNSET:
                 raise ValueError("operation %s requires an argument" % name)
         else:
             if arg is not UNSET:
                 raise ValueError("operation %s has no argument" % name)
 
-        if self._has_jump(opcode):
+        if flags & _HAS_JUMP:
             if not isinstance(arg, (Label, _bytecode.BasicBlock)):
                 raise TypeError("operation %s argument type must be "
                                 "Label or BasicBlock, got %s"
                                 % (name, type(arg).__name__))
 
-        elif opcode in _opcode.hasfree:
+        elif flags & _HAS_FREE:
             if not isinstance(arg, (CellVar, FreeVar)):
                 raise TypeError("operation %s argument must be CellVar "
                                 "or FreeVar, got %s"
                                 % (name, type(arg).__name__))
 
-        elif (opcode in _opcode.haslocal
-              or opcode in _opcode.hasname):
+        elif flags & (_HAS_LOCAL | _HAS_NAME):
             if not isinstance(arg, str):
                 raise TypeError("operation %s argument must be a str, "
                                 "got %s"
                                 % (name, type(arg).__name__))
 
-        elif opcode in _opcode.hasconst:
+        elif flags & _HAS_CONST:
             if isinstance(arg, Label):
                 raise ValueError("label argument cannot be used "
                                  "in %s operation" % name)
@@ -171,13 +251,13 @@ class Instr:
                 raise ValueError("block argument cannot be used "
                                  "in %s operation" % name)
 
-        elif opcode in _opcode.hascompare:
+        elif flags & _HAS_COMPARE:
             if not isinstance(arg, Compare):
                 raise TypeError("operation %s argument type must be "
                                 "Compare, got %s"
                                 % (name, type(arg).__name__))
 
-        elif opcode >= _opcode.HAVE_ARGUMENT:
+        elif flags & _HAS_ARG:
             _check_arg_int(name, arg)
 
     def _set(self, name, arg, lineno):
@@ -194,7 +274,6 @@ class Instr:
 
         self._check_arg(name, opcode, arg)
 
-        opcode = _opcode.opmap[name]
         self._name = name
         self._opcode = opcode
         self._arg = arg
@@ -209,7 +288,7 @@ class Instr:
 
     def require_arg(self):
         """Does the instruction require an argument?"""
-        return (self._opcode >= _opcode.HAVE_ARGUMENT)
+        return bool(_OPCODE_FLAGS[self._opcode] & _HAS_ARG)
 
     @property
     def name(self):
@@ -254,9 +333,10 @@ class Instr:
         self._set(self._name, self._arg, lineno)
 
     def stack_effect(self, jump=None):
-        if self._opcode < _opcode.HAVE_ARGUMENT:
+        flags = _OPCODE_FLAGS[self._opcode]
+        if not flags & _HAS_ARG:
             arg = None
-        elif not isinstance(self._arg, int) or self._opcode in _opcode.hasconst:
+        elif not isinstance(self._arg, int) or flags & _HAS_CONST:
             # Argument is either a non-integer or an integer constant,
             # not oparg.
             arg = 0
@@ -272,7 +352,7 @@ class Instr:
             return dis.stack_effect(self._opcode, arg, jump=jump)
 
     def copy(self):
-        return self.__class__(self._name, self._arg, lineno=self._lineno)
+        return self._create(self._opcode, self._arg, self._lineno)
 
     def __repr__(self):
         if self._arg is not UNSET:
@@ -284,7 +364,7 @@ class Instr:
 
     def _cmp_key(self, labels=None):
         arg = self._arg
-        if self._opcode in _opcode.hasconst:
+        if _OPCODE_FLAGS[self._opcode] & _HAS_CONST:
             arg = const_key(arg)
         elif isinstance(arg, Label) and labels is not None:
             arg = labels[arg]
@@ -297,8 +377,7 @@ class Instr:
 
     @staticmethod
     def _has_jump(opcode):
-        return (opcode in _opcode.hasjrel
-                or opcode in _opcode.hasjabs)
+        return bool(_OPCODE_FLAGS[opcode] & _HAS_JUMP)
 
     def has_jump(self):
         return self._has_jump(self._opcode)
@@ -306,16 +385,11 @@ class Instr:
     def is_cond_jump(self):
         """Is a conditional jump?"""
         # Ex: POP_JUMP_IF_TRUE, JUMP_IF_FALSE_OR_POP
-        return ('JUMP_IF_' in self._name)
+        return bool(_OPCODE_FLAGS[self._opcode] & _IS_COND_JUMP)
 
     def is_uncond_jump(self):
         """Is an unconditional jump?"""
-        return self.name in {'JUMP_FORWARD', 'JUMP_ABSOLUTE'}
+        return bool(_OPCODE_FLAGS[self._opcode] & _IS_UNCOND_JUMP)
 
     def is_final(self):
-        if self._name in {'RETURN_VALUE', 'RAISE_VARARGS',
-                          'BREAK_LOOP', 'CONTINUE_LOOP'}:
-            return True
-        if self.is_uncond_jump():
-            return True
-        return False
+        return bool(_OPCODE_FLAGS[self._opcode] & _IS_FINAL)
@@ -0,0 +1,164 @@
+"""
+Pass manager: run a pipeline of optimization passes on a control flow graph
+until a fixed point is reached.
+"""
+import collections
+import operator
+import time
+
+
+PassStatistics = collections.namedtuple('PassStatistics',
+                                        'name runs changes time')
+
+_get_opcode = operator.attrgetter('_opcode')
+_get_arg = operator.attrgetter('_arg')
+
+
+def _block_state(block):
+    # Instructions are mutable: the state stores their opcode and argument.
+    # Objects are compared by identity, the state keeps a reference to them
+    # to ensure that their identifier is not reused. Line numbers are
+    # ignored.
+    instrs = tuple(list.__iter__(block))
+    try:
+        opcodes = tuple(map(_get_opcode, instrs))
+        args = tuple(map(_get_arg, instrs))
+    except AttributeError:
+        # SetLineno
+        opcodes = tuple(getattr(instr, '_opcode', None) for instr in instrs)
+        args = tuple(getattr(instr, '_arg', None) for instr in instrs)
+    next_block = block.next_block
+    key = (tuple(map(id, instrs)), opcodes, tuple(map(id, args)),
+           id(next_block))
+    return (key, (block, instrs, args, next_block))
+
+
+def _cfg_state(cfg):
+    # id(block) => block state
+    return {id(block): _block_state(block) for block in cfg}
+
+
+class _Pass:
+
+    def __init__(self, func, name, per_block):
+        self.func = func
+        self.name = name
+        self.per_block = per_block
+        self.runs = 0
+        self.changes = 0
+        self.time = 0.0
+        # state of the current run: whether the graph was modified since the
+        # last run of the pass, and blocks modified since the last run of the
+        # pass (id(block) => block) for per-block passes
+        self.stale = True
+        self.dirty = {}
+
+
+class PassManager:
+    """Run a pipeline of optimization passes until a fixed point is reached.
+
+    Passes modify the control flow graph in-place. Changes are detected by
+    comparing the content of the blocks before and after each pass: a pass
+    is only run again if the graph was modified since its last run, and a
+    per-block pass is only run again on modified blocks. A pass can return
+    the number of changes: if it returns 0, the blocks are not compared.
+    """
+
+    def __init__(self, passes=(), *, max_iterations=10):
+        if max_iterations < 1:
+            raise ValueError("max_iterations must be at least 1")
+        self.max_iterations = max_iterations
+        # number of iterations of the last run
+        self.iterations = 0
+        self._passes = []
+        for func in passes:
+            self.add_pass(func)
+
+    def add_pass(self, func, name=None, *, per_block=False):
+        """Add a pass at the end of the pipeline.
+
+        func(cfg) is called, or func(cfg, block) for each modified block if
+        per_block is true. The name defaults to the function name.
+        """
+        if name is None:
+            name = func.__name__
+        if any(pass_.name == name for pass_ in self._passes):
+            raise ValueError("duplicated pass name: %r" % name)
+        self._passes.append(_Pass(func, name, per_block))
+
+    def _run_pass(self, pass_, cfg):
+        # Return the result of the pass: number of changes or None
+        start_time = time.perf_counter()
+        if pass_.per_block:
+            blocks = [block for block in cfg if id(block) in pass_.dirty]
+            pass_.dirty.clear()
+            results = [pass_.func(cfg, block) for block in blocks]
+            result = None if None in results else sum(results)
+        else:
+            pass_.stale = False
+            result = pass_.func(cfg)
+        pass_.time += time.perf_counter() - start_time
+        pass_.runs += 1
+        return result
+
+    def run(self, cfg):
+        """Run the passes on cfg.
+
+        Return True if a fixed point was reached, or False if the passes
+        still modified the graph after max_iterations iterations.
+        """
+        states = _cfg_state(cfg)
+        for pass_ in self._passes:
+            pass_.stale = True
+            pass_.dirty = {block_id: state[1][0]
+                           for block_id, state in states.items()}
+
+        self.iterations = 0
+        while self.iterations < self.max_iterations:
+            self.iterations += 1
+            modified = False
+            for pass_ in self._passes:
+                if pass_.per_block:
+                    if not pass_.dirty:
+                        continue
+                elif not pass_.stale:
+                    continue
+
+                result = self._run_pass(pass_, cfg)
+                if result is not None and not result:
+                    continue
+
+                new_states = _cfg_state(cfg)
+                changed = {block_id: state[1][0]
+                           for block_id, state in new_states.items()
+                           if block_id not in states
+                           or states[block_id][0] != state[0]}
+                changes = (len(changed)
+                           + sum(1 for block_id in states
+                                 if block_id not in new_states))
+                states = new_states
+                if not changes:
+                    continue
+
+                pass_.changes += changes
+                modified = True
+                for other in self._passes:
+                    other.stale = True
+                    if other.per_block:
+                        other.dirty.update(changed)
+
+            if not modified:
+                return True
+        return False
+
+    def statistics(self):
+        """Get statistics on the passes: list of PassStatistics."""
+        return [PassStatistics(pass_.name, pass_.runs, pass_.changes,
+                               pass_.time)
+                for pass_ in self._passes]
+
+    def reset_statistics(self):
+        for pass_ in self._passes:
+            pass_.runs = 0
+            pass_.changes = 0
+            pass_.time = 0.0
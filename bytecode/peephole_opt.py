@@ -2,10 +2,15 @@
 Peephole optimizer of CPython 3.6 reimplemented in pure Python using
 the bytecode module.
 """
+import collections
+import functools
 import opcode
 import operator
 import sys
+import types
 from bytecode import Instr, Bytecode, ControlFlowGraph, BasicBlock, Compare
+from bytecode.cfg_opt import propagate_constants
+from bytecode.passes import PassManager
 
 JUMPS_ON_TRUE = frozenset((
     'POP_JUMP_IF_TRUE',
@@ -50,16 +55,30 @@ class PeepholeOptimizer:
     a single pass.  Code offset is adjusted accordingly.
     """
 
+    # maximum number of iterations of the optimization passes
+    max_iterations = 10
+
     def __init__(self):
         # bytecode.ControlFlowGraph instance
         self.code = None
+        # bytecode.passes.PassManager used by the last optimize_cfg() call
+        self.pass_manager = None
         self.const_stack = None
         self.block_index = None
+        # Block being optimized: its instructions are read once, from left
+        # to right, and copied to self.output with the optimizations.
+        # Instructions before self.index were read: their slots can be
+        # reused by requeue().
         self.block = None
-        # index of the current instruction in self.block instructions
+        # index of the next instruction in self.block instructions
         self.index = None
+        # optimized instructions, self.output[-1] is the current instruction
+        self.output = None
         # whether we are in a LOAD_CONST sequence
         self.in_consts = False
+        # fast local variables set to a constant in the current block:
+        # name => constant
+        self.const_locals = None
 
     def check_result(self, value):
         try:
@@ -75,9 +94,7 @@ class PeepholeOptimizer:
         self.in_consts = True
 
         load_const = Instr('LOAD_CONST', result, lineno=instr.lineno)
-        start = self.index - nconst - 1
-        self.block[start:self.index] = (load_const,)
-        self.index -= nconst
+        self.output[-nconst - 1:] = (load_const,)
 
         if nconst:
             del self.const_stack[-nconst:]
@@ -102,6 +119,28 @@ class PeepholeOptimizer:
 
         self.replace_load_const(1, instr, result)
 
+    def eval_STORE_FAST(self, instr):
+        if self.const_stack:
+            # LOAD_CONST value; STORE_FAST name
+            self.const_locals[instr.arg] = self.const_stack[-1]
+        else:
+            self.const_locals.pop(instr.arg, None)
+
+    def eval_DELETE_FAST(self, instr):
+        self.const_locals.pop(instr.arg, None)
+
+    def eval_LOAD_FAST(self, instr):
+        try:
+            value = self.const_locals[instr.arg]
+        except KeyError:
+            return
+
+        # Replace LOAD_FAST with LOAD_CONST if the variable was set to a
+        # constant earlier in the block
+        load_const = Instr('LOAD_CONST', value, lineno=instr.lineno)
+        self.output[-1] = load_const
+        self.eval_LOAD_CONST(load_const)
+
     def eval_UNARY_POSITIVE(self, instr):
         return self.unaryop(operator.pos, instr)
 
@@ -129,7 +168,7 @@ class PeepholeOptimizer:
 
         # Replace UNARY_NOT+POP_JUMP_IF_FALSE with POP_JUMP_IF_TRUE
         instr.set('POP_JUMP_IF_TRUE', next_instr.arg)
-        del self.block[self.index]
+        self.index += 1
 
     def binop(self, op, instr):
         try:
@@ -203,34 +242,36 @@ class PeepholeOptimizer:
         if (self.const_stack
                 and instr.arg <= len(self.const_stack)):
             nconst = instr.arg
-            start = self.index - 1
-
-            # Rewrite LOAD_CONST instructions in the reverse order
-            load_consts = self.block[start - nconst:start]
-            self.block[start - nconst:start] = reversed(load_consts)
 
             # Remove BUILD_TUPLE+UNPACK_SEQUENCE
-            self.block[start:start + 2] = ()
-            self.index -= 2
+            del self.output[-1]
+            self.index += 1
+
+            # Rewrite LOAD_CONST instructions in the reverse order
+            self.output[-nconst:] = reversed(self.output[-nconst:])
             self.const_stack.clear()
+            self.requeue(self.output.pop())
             return
 
         if instr.arg == 1:
             # Replace BUILD_TUPLE 1 + UNPACK_SEQUENCE 1 with NOP
-            del self.block[self.index - 1:self.index + 1]
+            del self.output[-1]
+            self.index += 1
         elif instr.arg == 2:
             # Replace BUILD_TUPLE 2 + UNPACK_SEQUENCE 2 with ROT_TWO
             rot2 = Instr('ROT_TWO', lineno=instr.lineno)
-            self.block[self.index - 1:self.index + 1] = (rot2,)
-            self.index -= 1
+            del self.output[-1]
+            self.index += 1
+            self.requeue(rot2)
             self.const_stack.clear()
         elif instr.arg == 3:
             # Replace BUILD_TUPLE 3 + UNPACK_SEQUENCE 3
             # with ROT_THREE + ROT_TWO
             rot3 = Instr('ROT_THREE', lineno=instr.lineno)
             rot2 = Instr('ROT_TWO', lineno=instr.lineno)
-            self.block[self.index - 1:self.index + 1] = (rot3, rot2)
-            self.index -= 1
+            del self.output[-1]
+            self.index += 1
+            self.requeue(rot3, rot2)
             self.const_stack.clear()
 
     def build_tuple(self, instr, container_type):
@@ -285,7 +326,7 @@ class PeepholeOptimizer:
         # not (a is not b) -->  a is b
         # not (a not in b) -->  a in b
         instr.arg = new_arg
-        self.block[self.index - 1:self.index + 1] = (instr,)
+        self.index += 1
 
     def jump_if_or_pop(self, instr):
         # Simplify conditional jump to conditional jump where the
@@ -304,11 +345,17 @@ class PeepholeOptimizer:
         # x:JUMP_IF_FALSE_OR_POP y   y:JUMP_IF_TRUE_OR_POP z
         #    -->  x:POP_JUMP_IF_FALSE y+3
         # where y+3 is the instruction following the second test.
+        if self.fold_cond_jump(instr):
+            return
+
         target_block = instr.arg
         try:
-            target_instr = target_block[0]
+            target_instr = self.get_block_instrs(target_block)[0]
         except IndexError:
             return
+        if target_instr is instr:
+            # the block only contains the jump, which jumps to itself
+            return
 
         if not target_instr.is_cond_jump():
             self.optimize_jump_to_cond_jump(instr)
@@ -321,8 +368,7 @@ class PeepholeOptimizer:
             # The current opcode inherits its target's stack behaviour
             instr.name = target_instr.name
             instr.arg = target2
-            self.block[self.index - 1] = instr
-            self.index -= 1
+            self.requeue(self.output.pop())
         else:
             # The second jump is not taken if the first is (so jump past it),
             # and all conditional jumps pop their argument when they're not
@@ -337,8 +383,43 @@ class PeepholeOptimizer:
 
             instr.name = name
             instr.arg = new_label
-            self.block[self.index - 1] = instr
-            self.index -= 1
+            self.requeue(self.output.pop())
+
+    def fold_cond_jump(self, instr):
+        # Replace "LOAD_CONST value; <conditional jump>": the jump is either
+        # always taken or never taken. Return True if the jump was replaced.
+        if not self.const_stack:
+            return False
+        try:
+            value = bool(self.const_stack[-1])
+        except Exception:
+            return False
+        self.const_stack.clear()
+
+        if value != (instr.name in JUMPS_ON_TRUE):
+            # The jump is never taken: conditional jumps pop their argument
+            # when they are not taken
+            del self.output[-2:]
+            return True
+
+        # The jump is always taken
+        jump = Instr('JUMP_ABSOLUTE', instr.arg, lineno=instr.lineno)
+        if instr.name.startswith('POP_'):
+            self.output[-2:] = (jump,)
+        else:
+            # JUMP_IF_TRUE_OR_POP keeps the value when the jump is taken
+            self.output[-1] = jump
+        self.block.next_block = None
+        self.optimize_jump(jump)
+        return True
+
+    def eval_POP_JUMP_IF_FALSE(self, instr):
+        if not self.fold_cond_jump(instr):
+            self.optimize_jump(instr)
+
+    def eval_POP_JUMP_IF_TRUE(self, instr):
+        if not self.fold_cond_jump(instr):
+            self.optimize_jump(instr)
 
     def eval_JUMP_IF_FALSE_OR_POP(self, instr):
         self.jump_if_or_pop(instr)
@@ -348,45 +429,41 @@ class PeepholeOptimizer:
 
     def eval_NOP(self, instr):
         # Remove NOP
-        del self.block[self.index - 1]
-        self.index -= 1
+        del self.output[-1]
 
     def optimize_jump_to_cond_jump(self, instr):
         # Replace jumps to unconditional jumps
         jump_label = instr.arg
         assert isinstance(jump_label, BasicBlock), jump_label
-
         try:
-            target_instr = jump_label[0]
+            target_instr = self.get_block_instrs(jump_label)[0]
         except IndexError:
             return
 
         if (instr.is_uncond_jump()
                 and target_instr.name == 'RETURN_VALUE'):
             # Replace JUMP_ABSOLUTE => RETURN_VALUE with RETURN_VALUE
-            self.block[self.index - 1] = target_instr
+            self.output[-1] = target_instr
 
         elif target_instr.is_uncond_jump():
             # Replace JUMP_FORWARD t1 jumping to JUMP_FORWARD t2
-            # with JUMP_ABSOLUTE t2
-            jump_target2 = target_instr.arg
+            # with JUMP_ABSOLUTE t2, following chains of jumps
+            jump_target2 = self.get_jump_target(self.block, instr)
+            if jump_target2 is jump_label:
+                # cycle or backward relative jump
+                return
 
-            name = instr.name
             if instr.name == 'JUMP_FORWARD':
-                name = 'JUMP_ABSOLUTE'
-            else:
-                # FIXME: reimplement this check
-                # if jump_target2 < 0:
-                #    # No backward relative jumps
-                #    return
-
-                # FIXME: remove this workaround and implement comment code ^^
-                if instr.opcode in opcode.hasjrel:
-                    return
-
-            instr.name = name
+                instr.name = 'JUMP_ABSOLUTE'
             instr.arg = jump_target2
-            self.block[self.index - 1] = instr
+
+            try:
+                target_instr = self.get_block_instrs(jump_target2)[0]
+            except IndexError:
+                return
+            if (instr.is_uncond_jump()
+                    and target_instr.name == 'RETURN_VALUE'):
+                self.output[-1] = target_instr
 
     def optimize_jump(self, instr):
         if (instr.is_uncond_jump()
@@ -398,77 +475,238 @@ class PeepholeOptimizer:
             target_block = instr.arg
             target_block_index = self.code.get_block_index(target_block)
             if target_block_index == block_index:
-                del self.block[self.index - 1]
+                del self.output[-1]
                 self.block.next_block = target_block
                 return
 
         self.optimize_jump_to_cond_jump(instr)
 
+    def get_block_instrs(self, block):
+        # Instructions of a block: the instructions of the block being
+        # optimized are in self.output
+        if block is self.block and self.output is not None:
+            return self.output
+        return block
+
+    def requeue(self, *instrs):
+        # Insert instructions before the next instruction to optimize them
+        # again, reusing the slots of the instructions already read
+        for instr in reversed(instrs):
+            self.index -= 1
+            self.block[self.index] = instr
+
     def iterblock(self, block):
         self.block = block
         self.index = 0
+        self.output = []
         while self.index < len(block):
-            instr = self.block[self.index]
+            instr = block[self.index]
             self.index += 1
+            self.output.append(instr)
             yield instr
+        block[:] = self.output
+        self.output = None
+
+    @classmethod
+    def _get_dispatch_table(cls):
+        # Table opcode => function called with (self, instr), or None. It is
+        # computed once per class to take methods of subclasses into account:
+        # eval_<name>() methods, or optimize_jump() for jumps.
+        table = cls.__dict__.get('_dispatch_table')
+        if table is None:
+            table = []
+            for op in range(256):
+                meth = getattr(cls, 'eval_%s' % opcode.opname[op], None)
+                if meth is None and Instr._has_jump(op):
+                    meth = cls.optimize_jump
+                table.append(meth)
+            table = tuple(table)
+            cls._dispatch_table = table
+        return table
 
     def optimize_block(self, block):
         self.const_stack.clear()
+        self.const_locals.clear()
         self.in_consts = False
 
+        dispatch_table = self._get_dispatch_table()
         for instr in self.iterblock(block):
             if not self.in_consts:
                 self.const_stack.clear()
             self.in_consts = False
 
-            meth_name = 'eval_%s' % instr.name
-            meth = getattr(self, meth_name, None)
+            meth = dispatch_table[instr.opcode]
             if meth is not None:
-                meth(instr)
-            elif instr.has_jump():
-                self.optimize_jump(instr)
-
-            # Note: Skipping over LOAD_CONST trueconst; POP_JUMP_IF_FALSE
-            # <target> is not implemented, since it looks like the optimization
-            # is never trigerred in practice. The compiler already optimizes if
-            # and while statements.
+                meth(self, instr)
 
     def remove_dead_blocks(self):
-        # FIXME: remove empty blocks?
-
-        used_blocks = {id(self.code[0])}
-        for block in self.code:
-            if block.next_block is not None:
-                used_blocks.add(id(block.next_block))
-            for instr in block:
-                if (isinstance(instr, Instr)
-                        and isinstance(instr.arg, BasicBlock)):
-                    used_blocks.add(id(instr.arg))
-
+        # Remove blocks which are not reachable from the entry block.
+        # Return the number of removed blocks.
+        entry = self.code[0]
+        used_blocks = {id(entry)}
+        pending = [entry]
+        while pending:
+            block = pending.pop()
+            for successor in self.code.get_successors(block):
+                if id(successor) not in used_blocks:
+                    used_blocks.add(id(successor))
+                    pending.append(successor)
+
+        removed = 0
         block_index = 0
         while block_index < len(self.code):
             block = self.code[block_index]
             if id(block) not in used_blocks:
                 del self.code[block_index]
+                removed += 1
             else:
                 block_index += 1
+        return removed
+
+    def get_jump_target(self, block, instr):
+        # Get the final target of the jump instr at the end of block: skip
+        # empty blocks and blocks only made of an unconditional jump. Stop at
+        # the first cycle. Relative jumps can only jump forward, except of
+        # JUMP_FORWARD which is replaced with JUMP_ABSOLUTE by
+        # set_jump_opcodes() if needed.
+        relative = (instr.opcode in opcode.hasjrel
+                    and instr.name != 'JUMP_FORWARD')
+        block_index = self.code.get_block_index(block)
+
+        target = new_target = instr.arg
+        seen = set()
+        while True:
+            seen.add(id(target))
+            instrs = self.get_block_instrs(target)
+            if not instrs:
+                next_target = target.next_block
+            elif (len(instrs) == 1
+                    and isinstance(instrs[0], Instr)
+                    and instrs[0].is_uncond_jump()):
+                next_target = instrs[0].arg
+            else:
+                break
+            if next_target is None or id(next_target) in seen:
+                break
+
+            target = next_target
+            if (not relative
+                    or self.code.get_block_index(target) > block_index):
+                new_target = target
+        return new_target
+
+    def thread_jumps(self):
+        # Retarget jumps and fall-through links to their final target.
+        # Return the number of retargeted jumps and links.
+        threaded = 0
+        for block in self.code:
+            next_block = block.next_block
+            while (next_block is not None and not next_block
+                    and next_block.next_block is not None):
+                next_block = next_block.next_block
+            if next_block is not block.next_block:
+                block.next_block = next_block
+                threaded += 1
+
+            target_block = block.get_jump()
+            if target_block is None:
+                continue
+            instr = block[-1]
+            target = self.get_jump_target(block, instr)
+            if target is not target_block:
+                instr.arg = target
+                threaded += 1
+        return threaded
+
+    def merge_blocks(self):
+        # Remove unconditional jumps to the following block. Merge block1
+        # with block2 if block1 doesn't end with a jump, block1.next_block is
+        # block2 and no jump targets block2. Return the number of removed
+        # jumps and merged blocks.
+        merged = 0
+        jump_targets = collections.Counter(id(block.get_jump())
+                                           for block in self.code)
 
-        # FIXME: merge following blocks if block1 does not contain any
-        # jump and block1.next_block is block2
+        block_index = 0
+        while block_index < len(self.code) - 1:
+            block = self.code[block_index]
+            next_block = self.code[block_index + 1]
+            target_block = block.get_jump()
+            if target_block is next_block and block[-1].is_uncond_jump():
+                del block[-1]
+                block.next_block = next_block
+                jump_targets[id(next_block)] -= 1
+                target_block = None
+                merged += 1
+
+            if (target_block is not None
+                    or block.next_block is not next_block
+                    or jump_targets[id(next_block)]):
+                block_index += 1
+                continue
+
+            block.extend(next_block)
+            block.next_block = next_block.next_block
+            del self.code[block_index + 1]
+            merged += 1
+        return merged
+
+    def simplify_cfg(self):
+        # Thread jumps to jumps, remove empty and unreachable blocks, and
+        # merge straight-line blocks. Return the number of changes.
+        changes = self.thread_jumps()
+        changes += self.remove_dead_blocks()
+
+        entry = self.code[0]
+        if not entry and entry.next_block is not None:
+            del self.code[0]
+            changes += 1
+
+        changes += self.merge_blocks()
+        return changes
+
+    def set_jump_opcodes(self):
+        # Once the layout of blocks is known, replace JUMP_FORWARD jumping
+        # backward with JUMP_ABSOLUTE
+        for block_index, block in enumerate(self.code):
+            target_block = block.get_jump()
+            if target_block is None or block[-1].name != 'JUMP_FORWARD':
+                continue
+            if self.code.get_block_index(target_block) <= block_index:
+                block[-1].name = 'JUMP_ABSOLUTE'
+
+    def _optimize_block(self, cfg, block):
+        self.block_index = cfg.get_block_index(block) + 1
+        self.optimize_block(block)
+
+    def create_pass_manager(self):
+        # Pipeline of passes run until a fixed point is reached: a fold can
+        # expose a constant condition, and a folded jump can allow to merge
+        # blocks. Subclasses can override this method to add passes.
+        manager = PassManager(max_iterations=self.max_iterations)
+        manager.add_pass(lambda cfg: self.remove_dead_blocks(),
+                         'remove_dead_blocks')
+        # replace LOAD_FAST with LOAD_CONST for the constant folding
+        manager.add_pass(propagate_constants)
+        manager.add_pass(self._optimize_block, 'optimize_block',
+                         per_block=True)
+        manager.add_pass(lambda cfg: self.simplify_cfg(), 'simplify_cfg')
+        return manager
 
     def optimize_cfg(self, cfg):
         self.code = cfg
         self.const_stack = []
+        self.const_locals = {}
 
-        self.remove_dead_blocks()
+        self.pass_manager = self.create_pass_manager()
+        self.pass_manager.run(cfg)
+        self.set_jump_opcodes()
 
-        self.block_index = 0
-        while self.block_index < len(self.code):
-            block = self.code[self.block_index]
-            self.block_index += 1
-            self.optimize_block(block)
+    def optimize(self, code_obj, *, recursive=False):
+        if recursive:
+            # the optimizer is reused for all code objects of the tree
+            return _transform_tree(code_obj, self.optimize)
 
-    def optimize(self, code_obj):
         bytecode = Bytecode.from_code(code_obj)
         cfg = ControlFlowGraph.from_bytecode(bytecode)
 
@@ -479,13 +717,78 @@ class PeepholeOptimizer:
         return code
 
 
+def _replace_consts(code, consts):
+    if sys.version_info >= (3, 8):
+        return code.replace(co_consts=consts)
+    return types.CodeType(code.co_argcount,
+                          code.co_kwonlyargcount,
+                          code.co_nlocals,
+                          code.co_stacksize,
+                          code.co_flags,
+                          code.co_code,
+                          consts,
+                          code.co_names,
+                          code.co_varnames,
+                          code.co_filename,
+                          code.co_name,
+                          code.co_firstlineno,
+                          code.co_lnotab,
+                          code.co_freevars,
+                          code.co_cellvars)
+
+
+def _transform_tree(code, transform):
+    # Transform the nested code objects (functions, classes, lambdas,
+    # comprehensions) bottom-up, and then the code object
+    consts = tuple(_transform_tree(const, transform)
+                   if isinstance(const, types.CodeType) else const
+                   for const in code.co_consts)
+    if any(const is not old_const
+           for const, old_const in zip(consts, code.co_consts)):
+        code = _replace_consts(code, consts)
+    return transform(code)
+
+
 # Code transformer for the PEP 511
 class CodeTransformer:
     name = "pyopt"
+    # Version of the generated code: change it to invalidate the entries of
+    # persistent caches when the optimizer output changes
+    version = 6
 
-    def code_transformer(self, code, context):
+    def __init__(self, cache=None, *, recursive=False):
+        # bytecode.cache.TransformCache or None
+        self.cache = cache
+        # if true, nested code objects are also transformed
+        self.recursive = recursive
+
+    def _optimize(self, optimizer, code):
         if sys.flags.verbose:
             print("Optimize %s:%s: %s"
                   % (code.co_filename, code.co_firstlineno, code.co_name))
-        optimizer = PeepholeOptimizer()
         return optimizer.optimize(code)
+
+    def code_transformer(self, code, context):
+        # The optimizer and the digests of code objects computed by the cache
+        # are shared by all code objects of the tree
+        optimize = functools.partial(self._optimize, PeepholeOptimizer())
+        if self.cache is None:
+            transform = optimize
+        else:
+            cls = type(self)
+            key = ('%s.%s' % (cls.__module__, cls.__qualname__),
+                   self.name, self.version)
+            digests = {}
+
+            def transform(code):
+                return self.cache.transform(code, optimize, key,
+                                            digests=digests)
+
+        if self.recursive:
+            return _transform_tree(code, transform)
+        return transform(code)
+
+
+if __name__ == "__main__":
+    from bytecode.batch import main
+    sys.exit(main())
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import contextlib
+import importlib.util
+import io
+import os
+import py_compile
+import shutil
+import tempfile
+import textwrap
+import unittest
+from bytecode import Instr, Bytecode
+from bytecode import batch
+from bytecode.peephole_opt import CodeTransformer
+from bytecode.tests import TestCase
+
+
+SOURCE = textwrap.dedent("""
+    def func():
+        def inner():
+            return 'old'
+        return inner()
+
+    VALUE = func()
+""")
+
+
+class ReplaceConst(CodeTransformer):
+    # Replace the 'old' constant with 'new'
+
+    def code_transformer(self, code, context):
+        bytecode = Bytecode.from_code(code)
+        for instr in bytecode:
+            if (isinstance(instr, Instr) and instr.name == 'LOAD_CONST'
+                    and instr.arg == 'old'):
+                instr.arg = 'new'
+        return bytecode.to_code()
+
+
+class CountTransformer(CodeTransformer):
+    # Record the names of the transformed code objects
+
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.names = []
+
+    def _optimize(self, optimizer, code):
+        self.names.append(code.co_name)
+        return super()._optimize(optimizer, code)
+
+
+class BatchTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def create_file(self, name, content=SOURCE):
+        filename = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as fp:
+            fp.write(content)
+        return filename
+
+    def load_module(self, filename):
+        if filename.endswith('.pyc'):
+            loader = importlib.machinery.SourcelessFileLoader('mod', filename)
+        else:
+            loader = importlib.machinery.SourceFileLoader('mod', filename)
+        spec = importlib.util.spec_from_file_location('mod', filename,
+                                                      loader=loader)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def test_optimize_file(self):
+        filename = self.create_file('mod.py')
+        pyc_filename = batch.optimize_file(filename, ReplaceConst())
+        self.assertEqual(pyc_filename,
+                         importlib.util.cache_from_source(filename))
+
+        # the .pyc file is valid and the nested function is transformed
+        self.assertEqual(self.load_module(filename).VALUE, 'new')
+
+        # the default transformer is the peephole optimizer
+        batch.optimize_file(filename)
+        self.assertEqual(self.load_module(filename).VALUE, 'old')
+
+    def test_transform_once(self):
+        filename = self.create_file('mod.py')
+        # each code object is transformed once, nested code objects first
+        for recursive in (False, True):
+            transformer = CountTransformer(recursive=recursive)
+            batch.optimize_file(filename, transformer)
+            self.assertEqual(transformer.names,
+                             ['inner', 'func', '<module>'])
+
+    def test_optimize_pyc(self):
+        source = self.create_file('mod.py')
+        filename = os.path.join(self.directory, 'mod.pyc')
+        py_compile.compile(source, filename, doraise=True)
+        os.unlink(source)
+        with open(filename, 'rb') as fp:
+            header = fp.read(batch._PYC_HEADER_SIZE)
+
+        self.assertEqual(batch.optimize_file(filename, ReplaceConst()),
+                         filename)
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(batch._PYC_HEADER_SIZE), header)
+        self.assertEqual(self.load_module(filename).VALUE, 'new')
+
+        with open(filename, 'wb') as fp:
+            fp.write(b'not a pyc file')
+        with self.assertRaises(ValueError):
+            batch.optimize_file(filename)
+
+    def test_find_files(self):
+        self.create_file('pkg/__init__.py')
+        self.create_file('pkg/mod.py')
+        self.create_file('pkg/mod.pyc')
+        self.create_file('pkg/sourceless.pyc')
+        self.create_file('pkg/data.txt')
+        self.create_file('pkg/__pycache__/mod.cpython-38.pyc')
+        self.create_file('pkg/sub/submod.py')
+        script = self.create_file('script')
+
+        files = batch.find_files([os.path.join(self.directory, 'pkg'),
+                                  script])
+        self.assertEqual([os.path.relpath(filename, self.directory)
+                          for filename in files],
+                         [os.path.join('pkg', '__init__.py'),
+                          os.path.join('pkg', 'mod.py'),
+                          os.path.join('pkg', 'sourceless.pyc'),
+                          os.path.join('pkg', 'sub', 'submod.py'),
+                          'script'])
+
+    def check_optimize_files(self, workers):
+        filename = self.create_file('pkg/mod.py')
+        invalid = self.create_file('pkg/invalid.py', 'def func(:\n')
+
+        results = batch.optimize_files([self.directory], ReplaceConst(),
+                                       workers=workers)
+        self.assertEqual([result.filename for result in results],
+                         [invalid, filename])
+        self.assertIsNone(results[0].pyc_filename)
+        self.assertIsInstance(results[0].error, SyntaxError)
+        self.assertEqual(results[1],
+                         (filename,
+                          importlib.util.cache_from_source(filename),
+                          None))
+        self.assertEqual(self.load_module(filename).VALUE, 'new')
+
+    def test_optimize_files(self):
+        self.check_optimize_files(1)
+
+        with self.assertRaises(ValueError):
+            batch.optimize_files([self.directory], workers=0)
+
+    def test_optimize_files_processes(self):
+        self.check_optimize_files(2)
+
+    def test_main(self):
+        self.create_file('mod.py')
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(batch.main(['-j', '1', self.directory]), 0)
+        self.assertEqual(stdout.getvalue(), 'Optimized 1 files (0 errors)\n')
+
+        invalid = self.create_file('invalid.py', 'def func(:\n')
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            with contextlib.redirect_stderr(stderr):
+                self.assertEqual(batch.main(['-q', self.directory]), 1)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertTrue(stderr.getvalue().startswith('Error: %s: ' % invalid))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
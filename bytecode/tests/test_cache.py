@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from unittest import mock
+from bytecode import Label, Instr, ConcreteInstr, Bytecode, ConcreteBytecode
+from bytecode.cache import CodeCache, TransformCache
+from bytecode.peephole_opt import CodeTransformer
+from bytecode.tests import get_code, TestCase
+
+
+class CodeCacheTests(TestCase):
+
+    def test_concrete_from_code(self):
+        code = get_code("x = 1; y = x + 2")
+        cache = CodeCache()
+
+        concrete = cache.concrete_from_code(code)
+        self.assertEqual(concrete, ConcreteBytecode.from_code(code))
+        self.assertEqual(cache.cache_info(), (0, 1, 128, 1))
+
+        concrete2 = cache.concrete_from_code(code)
+        self.assertEqual(concrete2, concrete)
+        self.assertEqual(cache.cache_info(), (1, 1, 128, 1))
+
+        # the result is a copy
+        self.assertIsNot(concrete2, concrete)
+        self.assertIsNot(concrete2[0], concrete[0])
+        self.assertIsNot(concrete2.consts, concrete.consts)
+        concrete2[0].arg = 1
+        concrete2.names.append('z')
+        self.assertEqual(cache.concrete_from_code(code), concrete)
+
+        # extended_arg is part of the key
+        cache.concrete_from_code(code, extended_arg=True)
+        self.assertEqual(cache.cache_info(), (2, 2, 128, 2))
+
+    def test_bytecode_from_code(self):
+        code = get_code("""
+            for x in range(3):
+                if x:
+                    break
+        """)
+        cache = CodeCache()
+
+        bytecode = cache.bytecode_from_code(code)
+        self.assertEqual(bytecode, Bytecode.from_code(code))
+        bytecode2 = cache.bytecode_from_code(code)
+        self.assertEqual(bytecode2, bytecode)
+        self.assertEqual(cache.cache_info().hits, 1)
+
+        # labels are not shared
+        labels = {id(instr) for instr in bytecode if isinstance(instr, Label)}
+        labels2 = [instr for instr in bytecode2 if isinstance(instr, Label)]
+        self.assertTrue(labels2)
+        for label in labels2:
+            self.assertNotIn(id(label), labels)
+        for instr in bytecode2:
+            if isinstance(instr, Instr) and isinstance(instr.arg, Label):
+                self.assertIn(instr.arg, labels2)
+
+        self.assertEqual(bytecode2.to_code(), code)
+
+    def test_content_key(self):
+        cache = CodeCache()
+
+        # equal code objects share the same entry
+        cache.concrete_from_code(get_code("x = 1"))
+        cache.concrete_from_code(get_code("x = 1"))
+        self.assertEqual(cache.cache_info(), (1, 1, 128, 1))
+
+        # 1 and True are different constants
+        cache.concrete_from_code(get_code("x = True"))
+        self.assertEqual(cache.cache_info(), (1, 2, 128, 2))
+
+        # the code name is part of the key
+        code = get_code("def f(): pass\ndef g(): pass")
+        func1, func2 = [const for const in code.co_consts
+                        if hasattr(const, 'co_code')]
+        self.assertEqual(cache.bytecode_from_code(func1).name, 'f')
+        self.assertEqual(cache.bytecode_from_code(func2).name, 'g')
+
+    def test_extended_args(self):
+        code = ConcreteBytecode([ConcreteInstr('EXTENDED_ARG', 0),
+                                 ConcreteInstr('LOAD_CONST', 0),
+                                 ConcreteInstr('RETURN_VALUE')],
+                                consts=[None])
+        code_obj = code.to_code(stacksize=1)
+
+        cache = CodeCache()
+        cache.concrete_from_code(code_obj)
+        concrete = cache.concrete_from_code(code_obj)
+        self.assertEqual(concrete.to_code(stacksize=1).co_code,
+                         code_obj.co_code)
+
+    def test_lru(self):
+        codes = [get_code("x = %s" % index) for index in range(3)]
+        cache = CodeCache(maxsize=2)
+
+        cache.concrete_from_code(codes[0])
+        cache.concrete_from_code(codes[1])
+        cache.concrete_from_code(codes[0])
+        # evict codes[1], the least recently used
+        cache.concrete_from_code(codes[2])
+        self.assertEqual(cache.cache_info(), (1, 3, 2, 2))
+
+        cache.concrete_from_code(codes[0])
+        self.assertEqual(cache.cache_info(), (2, 3, 2, 2))
+        cache.concrete_from_code(codes[1])
+        self.assertEqual(cache.cache_info(), (2, 4, 2, 2))
+
+        cache.clear()
+        self.assertEqual(cache.cache_info(), (0, 0, 2, 0))
+
+        with self.assertRaises(ValueError):
+            CodeCache(maxsize=0)
+
+
+class TransformCacheTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def transform(self, code):
+        self.calls += 1
+        return get_code("transformed = 1")
+
+    def get_entries(self):
+        return [filename for filename in os.listdir(self.directory)
+                if filename.endswith('.bytecode')]
+
+    def test_transform(self):
+        self.calls = 0
+        code = get_code("x = 1")
+        cache = TransformCache(self.directory)
+
+        new_code = cache.transform(code, self.transform, 'tr')
+        self.assertEqual(new_code.co_names, ('transformed',))
+        self.assertEqual((cache.hits, cache.misses, self.calls), (0, 1, 1))
+        self.assertEqual(len(self.get_entries()), 1)
+
+        # a new cache reads the entry from the disk
+        cache = TransformCache(self.directory)
+        new_code2 = cache.transform(get_code("x = 1"), self.transform, 'tr')
+        self.assertEqual(new_code2, new_code)
+        self.assertEqual((cache.hits, cache.misses, self.calls), (1, 0, 1))
+
+        # the code and the transformer key are part of the key
+        cache.transform(get_code("x = 2"), self.transform, 'tr')
+        cache.transform(code, self.transform, ('tr', 2))
+        self.assertEqual((cache.hits, cache.misses, self.calls), (1, 2, 3))
+        self.assertEqual(len(self.get_entries()), 3)
+
+        # no temporary file is left
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+    def test_const_key(self):
+        self.calls = 0
+        cache = TransformCache(self.directory)
+        for source in ("x = 1", "x = True", "x = 1.0", "x = -0.0",
+                       "x = 0.0", "x = '1'", "x = b'1'", "x = (1,)",
+                       "x = frozenset({1})"):
+            cache.transform(get_code(source), self.transform, 'tr')
+        self.assertEqual(cache.misses, 9)
+        self.assertEqual(len(self.get_entries()), 9)
+
+    def test_magic_number(self):
+        code = get_code("x = 1")
+        cache = TransformCache(self.directory)
+        path = cache._get_path(code, 'tr')
+        # the magic number changes in pre-releases, not the cache tag
+        with mock.patch('importlib.util.MAGIC_NUMBER', b'\x00\x00\r\n'):
+            self.assertNotEqual(cache._get_path(code, 'tr'), path)
+        self.assertEqual(cache._get_path(code, 'tr'), path)
+
+    def test_corrupted_entry(self):
+        self.calls = 0
+        code = get_code("x = 1")
+        cache = TransformCache(self.directory)
+        cache.transform(code, self.transform, 'tr')
+
+        filename = os.path.join(self.directory, self.get_entries()[0])
+        with open(filename, 'wb') as fp:
+            fp.write(b'\xff')
+
+        new_code = cache.transform(code, self.transform, 'tr')
+        self.assertEqual(new_code.co_names, ('transformed',))
+        self.assertEqual((cache.hits, cache.misses, self.calls), (0, 2, 2))
+
+        # the entry was rewritten
+        self.assertEqual(cache.transform(code, self.transform, 'tr'),
+                         new_code)
+        self.assertEqual(cache.hits, 1)
+
+    def test_uncacheable(self):
+        self.calls = 0
+        cache = TransformCache(self.directory)
+
+        # constant which cannot be serialized
+        code = ConcreteBytecode([ConcreteInstr('LOAD_CONST', 0),
+                                 ConcreteInstr('RETURN_VALUE')],
+                                consts=[object()]).to_code()
+        cache.transform(code, self.transform, 'tr')
+        cache.transform(code, self.transform, 'tr')
+        self.assertEqual((cache.misses, self.calls), (2, 2))
+
+        # without directory, code objects without source file are not cached
+        cache = TransformCache()
+        cache.transform(get_code("x = 1"), self.transform, 'tr')
+        cache.transform(get_code("x = 1"), self.transform, 'tr')
+        self.assertEqual((cache.misses, self.calls), (2, 4))
+        self.assertEqual(self.get_entries(), [])
+
+    def test_pycache(self):
+        self.calls = 0
+        filename = os.path.join(self.directory, 'mod.py')
+        with open(filename, 'w') as fp:
+            fp.write("x = 1\n")
+        code = compile("x = 1\n", filename, 'exec')
+
+        cache = TransformCache()
+        cache.transform(code, self.transform, 'tr')
+        cache.transform(code, self.transform, 'tr')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        pycache = os.path.join(self.directory, '__pycache__')
+        self.assertEqual(len(os.listdir(pycache)), 1)
+
+    def test_code_transformer(self):
+        code = get_code("x = 1 + 2")
+        transformer = CodeTransformer(TransformCache(self.directory))
+        new_code = transformer.code_transformer(code, {})
+        self.assertIsInstance(new_code, types.CodeType)
+        self.assertEqual(transformer.code_transformer(code, {}), new_code)
+        self.assertEqual((transformer.cache.hits, transformer.cache.misses),
+                         (1, 1))
+
+        # no cache
+        self.assertEqual(CodeTransformer().code_transformer(code, {}),
+                         new_code)
+
+    def test_code_transformer_recursive(self):
+        code = get_code("""
+            def outer():
+                def inner():
+                    return 1 + 2
+                return inner
+        """)
+        transformer = CodeTransformer(TransformCache(self.directory),
+                                      recursive=True)
+        new_code = transformer.code_transformer(code, {})
+        # an entry per code object
+        self.assertEqual((transformer.cache.hits, transformer.cache.misses),
+                         (0, 3))
+        self.assertEqual(len(self.get_entries()), 3)
+
+        self.assertEqual(transformer.code_transformer(code, {}), new_code)
+        self.assertEqual((transformer.cache.hits, transformer.cache.misses),
+                         (3, 3))
+
+    def test_shared_digests(self):
+        self.calls = 0
+        code = get_code("""
+            def func():
+                return 1
+        """)
+        func = code.co_consts[0]
+        cache = TransformCache(self.directory)
+        digests = {}
+        cache.transform(func, self.transform, 'tr', digests=digests)
+        self.assertEqual(list(digests), [id(func)])
+
+        # the digest of the nested code object is reused
+        digests[id(func)] = (func, b'digest')
+        cache.transform(code, self.transform, 'tr', digests=digests)
+        self.assertEqual(cache.misses, 2)
+        cache.transform(code, self.transform, 'tr')
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -530,6 +530,77 @@ class BytecodeBlocksFunctionalTests(TestCase):
         other_block = BasicBlock()
         self.assertRaises(ValueError, blocks.get_block_index, other_block)
 
+    def test_get_block_index_after_edits(self):
+        blocks = ControlFlowGraph()
+        for index in range(9):
+            blocks.add_block([Instr('NOP'), Instr('NOP')])
+        self.check_getitem(blocks)
+
+        # interleave modifications and lookups
+        block3 = blocks[3]
+        del blocks[1]
+        self.assertEqual(blocks.get_block_index(block3), 2)
+        new_block = blocks.split_block(blocks[5], 1)
+        del blocks[-1]
+        self.assertEqual(blocks.get_block_index(new_block), 6)
+        blocks.split_block(blocks[0], 0)
+        block = blocks.add_block()
+        self.assertEqual(blocks.get_block_index(block), 9)
+        self.check_getitem(blocks)
+
+        deleted_block = blocks[4]
+        del blocks[deleted_block]
+        self.assertRaises(ValueError, blocks.get_block_index, deleted_block)
+        self.check_getitem(blocks)
+
+        # enough edits to rebuild the index
+        for index in range(100):
+            block = blocks.add_block([Instr('NOP'), Instr('NOP')])
+            new_block = blocks.split_block(block, 1)
+            self.assertEqual(blocks.get_block_index(new_block), len(blocks) - 1)
+            del blocks[index % 7 + 1]
+        self.check_getitem(blocks)
+
+    def test_predecessors(self):
+        code = ControlFlowGraph.from_bytecode(_disassemble("""
+            if test:
+                x = 1
+            else:
+                x = 2
+        """))
+        block0, block1, block2, block3 = code
+        self.assertEqual(code.get_successors(block0), [block1, block2])
+        self.assertEqual(code.get_successors(block1), [block3])
+        self.assertEqual(code.get_successors(block3), [])
+
+        self.assertEqual(code.get_predecessors(block0), [])
+        self.assertEqual(code.get_predecessors(block1), [block0])
+        self.assertEqual(code.get_predecessors(block2), [block0])
+        self.assertEqual(code.get_predecessors(block3), [block1, block2])
+        self.assertRaises(ValueError, code.get_predecessors, BasicBlock())
+
+        # edits of the CFG update predecessors
+        block4 = code.add_block()
+        self.assertEqual(code.get_predecessors(block4), [])
+        block5 = code.split_block(block0, 1)
+        self.assertEqual(code.get_predecessors(block5), [block0])
+        self.assertEqual(code.get_predecessors(block1), [block5])
+        del code[block2]
+        self.assertEqual(code.get_predecessors(block3), [block1])
+
+        # predecessors are cached: in-place edits of blocks require to
+        # invalidate them
+        block1[-1].arg = block4
+        self.assertEqual(code.get_predecessors(block4), [])
+        code.invalidate_edges()
+        self.assertEqual(code.get_predecessors(block3), [])
+        self.assertEqual(code.get_predecessors(block4), [block1])
+
+        # adding a block invalidates predecessors
+        block4.next_block = block3
+        code.add_block()
+        self.assertEqual(code.get_predecessors(block3), [block4])
+
 
 class CFGStacksizeComputationTests(TestCase):
 
@@ -571,6 +642,23 @@ class CFGStacksizeComputationTests(TestCase):
         with self.assertRaises(RuntimeError):
             code.compute_stacksize()
 
+    def test_stack_size_deep_cfg(self):
+        # The depth of the graph must not be limited by the recursion limit
+        nblocks = sys.getrecursionlimit() * 5
+        code = ControlFlowGraph()
+        block = code[0]
+        block.append(Instr("LOAD_CONST", None))
+        for index in range(nblocks):
+            next_block = code.add_block()
+            block.append(Instr("POP_JUMP_IF_TRUE", next_block))
+            block.next_block = next_block
+            block = next_block
+            block.extend([Instr("LOAD_CONST", index),
+                          Instr("LOAD_CONST", index),
+                          Instr("POP_TOP")])
+        block.append(Instr("RETURN_VALUE"))
+        self.assertEqual(code.compute_stacksize(), 2)
+
     def test_stack_size_computation_and(self):
         def test(arg1, *args, **kwargs):  # pragma: no cover
             return arg1 and args  # Test JUMP_IF_FALSE_OR_POP
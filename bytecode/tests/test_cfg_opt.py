@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+import builtins
+import types
+import unittest
+import weakref
+from bytecode import Instr, Bytecode, ControlFlowGraph
+from bytecode import cfg_opt
+from bytecode.tests import get_code, TestCase
+
+
+def get_cfg(source):
+    code = get_code(source, function=True)
+    return ControlFlowGraph.from_bytecode(Bytecode.from_code(code))
+
+
+def get_instrs(cfg):
+    return [(instr.name, instr.arg if instr.require_arg() else None)
+            for block in cfg for instr in block
+            if isinstance(instr, Instr)]
+
+
+def make_function(cfg):
+    code = cfg.to_code()
+    return types.FunctionType(code, {'__builtins__': builtins})
+
+
+class DeadStoreTests(TestCase):
+
+    def test_dead_store(self):
+        cfg = get_cfg("""
+            def func(x):
+                y = 1
+                z = x
+                y = x + 1
+                return y
+        """)
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 2)
+        self.assertEqual(get_instrs(cfg),
+                         [('LOAD_FAST', 'x'),
+                          ('LOAD_CONST', 1),
+                          ('BINARY_ADD', None),
+                          ('STORE_FAST', 'y'),
+                          ('LOAD_FAST', 'y'),
+                          ('RETURN_VALUE', None)])
+
+        code = cfg.to_code()
+        # z is removed from co_varnames
+        self.assertEqual(code.co_varnames, ('x', 'y'))
+        self.assertEqual(code.co_nlocals, 2)
+        self.assertEqual(make_function(cfg)(2), 3)
+
+    def test_unbound_variable(self):
+        # LOAD_FAST of a variable which may be unbound is kept
+        cfg = get_cfg("""
+            def func(x):
+                if x:
+                    y = 1
+                z = y
+        """)
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 1)
+        self.assertIn(('LOAD_FAST', 'y'), get_instrs(cfg))
+        self.assertNotIn(('STORE_FAST', 'z'), get_instrs(cfg))
+        func = make_function(cfg)
+        self.assertIsNone(func(1))
+        self.assertRaises(UnboundLocalError, func, 0)
+
+    def test_chained_assignment(self):
+        cfg = get_cfg("""
+            def func(x):
+                a = b = x
+                return b
+        """)
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 1)
+        self.assertNotIn(('DUP_TOP', None), get_instrs(cfg))
+        self.assertEqual(make_function(cfg)(5), 5)
+
+    def test_loop(self):
+        cfg = get_cfg("""
+            def func(n):
+                x = 0
+                total = 0
+                while n:
+                    total = total + x
+                    x = n
+                    unused = n
+                    n = n - 1
+                return total
+        """)
+        # unused holds the value of the previous iteration: removing the
+        # store would release it earlier
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 0)
+        self.assertIn(('STORE_FAST', 'unused'), get_instrs(cfg))
+        self.assertEqual(make_function(cfg)(4), 4 + 3 + 2)
+
+    def test_exception_handler(self):
+        cfg = get_cfg("""
+            def func(obj):
+                try:
+                    x = 2
+                    len(obj)
+                    x = 3
+                except TypeError:
+                    return x
+                unused = x
+                return 0
+        """)
+        # stores of the try block are read by the handler
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 1)
+        self.assertIn(('STORE_FAST', 'x'), get_instrs(cfg))
+        self.assertNotIn(('STORE_FAST', 'unused'), get_instrs(cfg))
+        func = make_function(cfg)
+        self.assertEqual(func(None), 2)
+        self.assertEqual(func([]), 0)
+
+    def test_delete(self):
+        cfg = get_cfg("""
+            def func():
+                x = 1
+                del x
+        """)
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 0)
+
+    def test_introspection(self):
+        cfg = get_cfg("""
+            def func():
+                x = 1
+                return locals()
+        """)
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 0)
+
+    def test_release_reference(self):
+        class Obj:
+            pass
+
+        refs = []
+
+        def factory():
+            obj = Obj()
+            refs.append(weakref.ref(obj))
+            return obj
+
+        def is_alive():
+            return refs[-1]() is not None
+
+        for value in ('None', '0'):
+            cfg = get_cfg("""
+                def func(factory, is_alive):
+                    x = factory()
+                    x.attr = 1
+                    x = %s
+                    return is_alive()
+            """ % value)
+            # the store releases the previous value of x
+            self.assertEqual(cfg_opt.remove_dead_stores(cfg), 0)
+            self.assertFalse(make_function(cfg)(factory, is_alive))
+
+        # "x = None" is kept even if x cannot hold a value
+        cfg = get_cfg("""
+            def func():
+                x = None
+        """)
+        self.assertEqual(cfg_opt.remove_dead_stores(cfg), 0)
+
+
+class ForwardStoresTests(TestCase):
+
+    def test_store_load(self):
+        cfg = get_cfg("""
+            def func(x):
+                y = x + 1
+                return y
+        """)
+        self.assertEqual(cfg_opt.forward_stores(cfg), 1)
+        self.assertEqual(get_instrs(cfg),
+                         [('LOAD_FAST', 'x'),
+                          ('LOAD_CONST', 1),
+                          ('BINARY_ADD', None),
+                          ('RETURN_VALUE', None)])
+        code = cfg.to_code()
+        self.assertEqual(code.co_varnames, ('x',))
+        self.assertEqual(make_function(cfg)(2), 3)
+
+    def test_dup_top(self):
+        cfg = get_cfg("""
+            def func(x):
+                v = x.attr
+                return v.phrase + v
+        """)
+        self.assertEqual(cfg_opt.forward_stores(cfg), 1)
+        self.assertEqual(get_instrs(cfg),
+                         [('LOAD_FAST', 'x'),
+                          ('LOAD_ATTR', 'attr'),
+                          ('DUP_TOP', None),
+                          ('LOAD_ATTR', 'phrase'),
+                          ('ROT_TWO', None),
+                          ('BINARY_ADD', None),
+                          ('RETURN_VALUE', None)])
+
+        class Value(str):
+            phrase = 'a'
+        obj = types.SimpleNamespace(attr=Value('b'))
+        self.assertEqual(make_function(cfg)(obj), 'ab')
+
+        cfg = get_cfg("""
+            def func(x):
+                v = -x
+                return v * v
+        """)
+        self.assertEqual(cfg_opt.forward_stores(cfg), 1)
+        self.assertEqual(get_instrs(cfg),
+                         [('LOAD_FAST', 'x'),
+                          ('UNARY_NEGATIVE', None),
+                          ('DUP_TOP', None),
+                          ('BINARY_MULTIPLY', None),
+                          ('RETURN_VALUE', None)])
+        self.assertEqual(make_function(cfg)(3), 9)
+
+    def test_live_variable(self):
+        cfg = get_cfg("""
+            def func(x):
+                v = x + 1
+                w = v.real
+                return w + v
+        """)
+        # v is live after v.real
+        self.assertEqual(cfg_opt.forward_stores(cfg), 1)
+        self.assertIn(('STORE_FAST', 'v'), get_instrs(cfg))
+        self.assertNotIn(('STORE_FAST', 'w'), get_instrs(cfg))
+        self.assertEqual(make_function(cfg)(2), 6)
+
+    def test_loop(self):
+        cfg = get_cfg("""
+            def func(n):
+                total = 0
+                for i in range(n):
+                    x = i * 2
+                    total = x + total
+                return total
+        """)
+        # i and x hold the values of the previous iteration: removing the
+        # stores would release them earlier. total is read by the next
+        # iteration.
+        self.assertEqual(cfg_opt.forward_stores(cfg), 0)
+        self.assertIn(('STORE_FAST', 'i'), get_instrs(cfg))
+        self.assertIn(('STORE_FAST', 'x'), get_instrs(cfg))
+        self.assertEqual(make_function(cfg)(4), 12)
+
+    def test_exception_handler(self):
+        cfg = get_cfg("""
+            def func(obj):
+                try:
+                    x = obj.attr
+                    return x * 2
+                except TypeError:
+                    return x
+        """)
+        # the handler reads x
+        self.assertEqual(cfg_opt.forward_stores(cfg), 0)
+
+        cfg = get_cfg("""
+            def func(obj):
+                try:
+                    x = obj.attr
+                    return x * 2
+                except (TypeError, AttributeError):
+                    return -1
+        """)
+        self.assertEqual(cfg_opt.forward_stores(cfg), 1)
+        func = make_function(cfg)
+        self.assertEqual(func(types.SimpleNamespace(attr='abc')), 'abcabc')
+        self.assertEqual(func(types.SimpleNamespace(attr=None)), -1)
+        self.assertEqual(func(None), -1)
+
+    def test_side_effect(self):
+        # f() can modify the stack: not a pure operation
+        cfg = get_cfg("""
+            def func(x):
+                v = x
+                return f(v) + v
+        """)
+        self.assertEqual(cfg_opt.forward_stores(cfg), 0)
+
+    def test_release_reference(self):
+        class Obj:
+            pass
+
+        refs = []
+
+        def factory():
+            obj = Obj()
+            refs.append(weakref.ref(obj))
+            return obj
+
+        def is_alive():
+            return refs[-1]() is not None
+
+        cfg = get_cfg("""
+            def func(factory, is_alive):
+                x = factory()
+                x.attr = 1
+                x = 0
+                return x + is_alive()
+        """)
+        # the store releases the previous value of x
+        self.assertEqual(cfg_opt.forward_stores(cfg), 0)
+        self.assertEqual(make_function(cfg)(factory, is_alive), 0)
+
+
+class PropagateConstantsTests(TestCase):
+
+    def test_branches(self):
+        cfg = get_cfg("""
+            def func(test):
+                size = 4
+                if test:
+                    size2 = 1
+                else:
+                    size2 = 1
+                return size * size2
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 2)
+        instrs = get_instrs(cfg)
+        self.assertNotIn(('LOAD_FAST', 'size'), instrs)
+        self.assertNotIn(('LOAD_FAST', 'size2'), instrs)
+        self.assertEqual(instrs[-4:], [('LOAD_CONST', 4),
+                                       ('LOAD_CONST', 1),
+                                       ('BINARY_MULTIPLY', None),
+                                       ('RETURN_VALUE', None)])
+        self.assertEqual(make_function(cfg)(True), 4)
+
+    def test_different_constants(self):
+        for other in ("2", "True", "1.0"):
+            cfg = get_cfg("""
+                def func(test):
+                    if test:
+                        x = 1
+                    else:
+                        x = %s
+                    return x
+            """ % other)
+            self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+    def test_not_constant(self):
+        # argument
+        cfg = get_cfg("""
+            def func(x, test):
+                if test:
+                    x = 1
+                return x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+        # loop
+        cfg = get_cfg("""
+            def func(n):
+                x = 0
+                while n:
+                    x = x + 1
+                    n = n - 1
+                return x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+        # possibly unbound
+        cfg = get_cfg("""
+            def func(test):
+                if test:
+                    x = 1
+                return x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+        # deleted
+        cfg = get_cfg("""
+            def func(test):
+                x = 1
+                if test:
+                    del x
+                return x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+    def test_exception_handler(self):
+        # the handler can see both values of x
+        cfg = get_cfg("""
+            def func():
+                x = 1
+                try:
+                    x = 2
+                    func()
+                except Exception:
+                    return x
+                return x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+        cfg = get_cfg("""
+            def func():
+                x = 1
+                try:
+                    func()
+                except Exception:
+                    return x
+                return x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 2)
+
+    def test_introspection(self):
+        cfg = get_cfg("""
+            def func():
+                x = 1
+                return locals(), x
+        """)
+        self.assertEqual(cfg_opt.propagate_constants(cfg), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
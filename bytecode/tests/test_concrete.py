@@ -117,6 +117,14 @@ class ConcreteInstrTests(TestCase):
         self.assertEqual(ConcreteInstr(
             'LOAD_CONST', 0x1234abcd).size, 8 if WORDCODE else 6)
 
+    def test_copy(self):
+        instr = ConcreteInstr('LOAD_CONST', 0x1234abcd, lineno=3)
+        copy = instr.copy()
+        self.assertIs(type(copy), ConcreteInstr)
+        self.assertEqual(copy, instr)
+        self.assertEqual(copy.size, instr.size)
+        self.assertEqual(copy.assemble(), instr.assemble())
+
     def test_disassemble(self):
         code = b'\t\x00d\x03' if WORDCODE else b'\td\x03\x00'
         instr = ConcreteInstr.disassemble(1, code, 0)
@@ -186,6 +194,24 @@ class ConcreteBytecodeTests(TestCase):
         with self.assertRaises(ValueError):
             ConcreteBytecode([Label()])
 
+    def test_to_code_assemble(self):
+        # to_code() must produce the same bytes than ConcreteInstr.assemble()
+        instructions = []
+        for arg in (0, 0xff, 0x100, 0xffff, 0x10000, 0x1234abcd):
+            for extended_args in (None, 0, 1, 3):
+                instr = ConcreteInstr('LOAD_CONST', arg,
+                                      extended_args=extended_args)
+                instructions.extend((instr, ConcreteInstr('POP_TOP')))
+        instructions.extend((SetLineno(3),
+                             ConcreteInstr('LOAD_CONST', 0),
+                             ConcreteInstr('RETURN_VALUE')))
+
+        code = ConcreteBytecode(instructions, consts=[None])
+        code_obj = code.to_code(stacksize=1)
+        expected = b''.join(instr.assemble() for instr in instructions
+                            if isinstance(instr, ConcreteInstr))
+        self.assertEqual(code_obj.co_code, expected)
+
     def test_to_code_lnotab(self):
         # x = 7
         # y = 8
@@ -478,6 +504,38 @@ class ConcreteFromCodeTests(TestCase):
                         ConcreteInstr('LOAD_CONST', 0xabcd, lineno=1)]
         self.assertListEqual(list(bytecode), expected)
 
+    def test_extended_arg_useless(self):
+        if not WORDCODE:
+            return
+
+        # EXTENDED_ARG 0 does not change the argument but its size must be
+        # kept to not break jump offsets
+        code = ConcreteBytecode([ConcreteInstr('EXTENDED_ARG', 0),
+                                 ConcreteInstr('LOAD_CONST', 0),
+                                 ConcreteInstr('RETURN_VALUE')],
+                                consts=[None])
+        code_obj = code.to_code(stacksize=1)
+        concrete = ConcreteBytecode.from_code(code_obj)
+        self.assertListEqual(list(concrete),
+                             [ConcreteInstr('LOAD_CONST', 0, lineno=1),
+                              ConcreteInstr('RETURN_VALUE', lineno=1)])
+        self.assertEqual(concrete[0].size, 4)
+        self.assertEqual(concrete.to_code(stacksize=1).co_code,
+                         code_obj.co_code)
+
+    def test_extended_arg_at_the_end(self):
+        code = ConcreteBytecode([ConcreteInstr('LOAD_CONST', 0),
+                                 ConcreteInstr('RETURN_VALUE'),
+                                 ConcreteInstr('EXTENDED_ARG', 1)],
+                                consts=[None])
+        code_obj = code.to_code(stacksize=1)
+        with self.assertRaises(ValueError):
+            ConcreteBytecode.from_code(code_obj)
+
+        concrete = ConcreteBytecode.from_code(code_obj, extended_arg=True)
+        self.assertEqual(concrete[-1],
+                         ConcreteInstr('EXTENDED_ARG', 1, lineno=1))
+
     def test_extended_arg_make_function(self):
         code_obj = get_code('''
             def foo(x: int, y: int):
@@ -763,6 +821,24 @@ class BytecodeToConcreteTests(TestCase):
         code.extend([ConcreteInstr("LOAD_DEREF", 0, lineno=1),
                      ConcreteInstr("LOAD_DEREF", 1, lineno=1)])
 
+    def test_names_order(self):
+        # names and varnames are numbered in order of first use
+        code = Bytecode()
+        code.argnames = ['arg']
+        names = ['name%s' % index for index in range(1000)]
+        for name in names + names[::-1]:
+            code.extend([Instr('LOAD_GLOBAL', name),
+                         Instr('STORE_FAST', 'v' + name),
+                         Instr('LOAD_FAST', 'arg')])
+        concrete = code.to_concrete_bytecode()
+        self.assertEqual(concrete.names, names)
+        self.assertEqual(concrete.varnames,
+                         ['arg'] + ['v' + name for name in names])
+        self.assertEqual(list(concrete[-3:]),
+                         [ConcreteInstr('LOAD_GLOBAL', 0, lineno=1),
+                          ConcreteInstr('STORE_FAST', 1, lineno=1),
+                          ConcreteInstr('LOAD_FAST', 0, lineno=1)])
+
     def test_compute_jumps_convergence(self):
         # Consider the following sequence of instructions:
         #
@@ -780,8 +856,9 @@ class BytecodeToConcreteTests(TestCase):
         # On second pass compute_jumps() the instr at Label1 will have offset
         # of 256 so will also be given an EXTENDED_ARG.
         #
-        # Thus we need to make an additional pass.  This test only verifies
-        # case where 2 passes is insufficient but three is enough.
+        # Thus we need to make an additional pass.  This test verifies that
+        # the jumps are resolved whatever the compute_jumps_passes value
+        # (ignored since compute_jumps() always converges).
 
         if not WORDCODE:
             # Could be done pre-WORDCODE, but that requires 2**16 bytes of
@@ -807,9 +884,16 @@ class BytecodeToConcreteTests(TestCase):
         # This should pass by default.
         code.to_code()
 
-        # Try with max of two passes:  it should raise
-        with self.assertRaises(RuntimeError):
-            code.to_code(compute_jumps_passes=2)
+        for passes in (None, 2):
+            concrete = code.to_concrete_bytecode(compute_jumps_passes=passes)
+            self.assertEqual(concrete[0].name, 'JUMP_ABSOLUTE')
+            self.assertEqual(concrete[0].arg, 258)
+            self.assertEqual(concrete[0].size, 4)
+            self.assertEqual(concrete[1].name, 'JUMP_ABSOLUTE')
+            self.assertEqual(concrete[1].arg, 304)
+            self.assertEqual(concrete[1].size, 4)
+            self.assertEqual(concrete.to_code().co_code[:8],
+                             b'\x90\x01q\x02\x90\x01q\x30')
 
     def test_extreme_compute_jumps_convergence(self):
         """Test of compute_jumps() requiring absurd number of passes.
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import unittest
+from bytecode import Instr, ControlFlowGraph
+from bytecode.dataflow import (BitSetDomain, DataFlowAnalysis, Liveness,
+                               ReachingDefinitions)
+from bytecode.tests import disassemble, TestCase
+
+
+def get_cfg(source):
+    bytecode = disassemble(source, function=True)
+    return ControlFlowGraph.from_bytecode(bytecode)
+
+
+def find_instr(cfg, name, arg, occurrence=0):
+    for block in cfg:
+        for index, instr in enumerate(block):
+            if (isinstance(instr, Instr) and instr.name == name
+                    and instr.arg == arg):
+                if not occurrence:
+                    return block, index
+                occurrence -= 1
+    raise ValueError("instruction not found")
+
+
+class BitSetDomainTests(unittest.TestCase):
+
+    def test_domain(self):
+        domain = BitSetDomain('abc')
+        self.assertEqual(len(domain), 3)
+        self.assertEqual(domain.bit('b'), 2)
+        self.assertEqual(domain.add('d'), 8)
+        self.assertEqual(domain.add('a'), 1)
+        self.assertIn('d', domain)
+        self.assertNotIn('e', domain)
+
+        bits = domain.to_bits('db')
+        self.assertEqual(bits, 10)
+        self.assertEqual(domain.to_items(bits), ['b', 'd'])
+        self.assertEqual(domain.to_items(0), [])
+
+
+class LivenessTests(TestCase):
+
+    def live_after(self, liveness, cfg, name, arg, occurrence=0):
+        block, index = find_instr(cfg, name, arg, occurrence)
+        for instr_index, instr, value in liveness.instr_values(block):
+            if instr_index == index:
+                return set(liveness.variables.to_items(value))
+
+    def test_dead_store(self):
+        cfg = get_cfg("""
+            def func(x):
+                y = 1
+                y = x
+                return y
+        """)
+        liveness = Liveness(cfg).run()
+        # y = 1 is a dead store
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'y'),
+                         {'x'})
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'y', 1),
+                         {'y'})
+        self.assertEqual(liveness.variables.to_items(liveness.get_in(cfg[0])),
+                         ['x'])
+        self.assertTrue(liveness.is_live(liveness.get_in(cfg[0]), 'x'))
+        self.assertFalse(liveness.is_live(liveness.get_in(cfg[0]), 'y'))
+        self.assertFalse(liveness.is_live(liveness.get_in(cfg[0]), 'z'))
+
+    def test_branches(self):
+        cfg = get_cfg("""
+            def func(test):
+                x = 1
+                y = 2
+                if test:
+                    z = x
+                else:
+                    z = 3
+                return z
+        """)
+        liveness = Liveness(cfg).run()
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'x'),
+                         {'test', 'x'})
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'y'),
+                         {'test', 'x'})
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'z'),
+                         {'z'})
+
+    def test_loop(self):
+        cfg = get_cfg("""
+            def func(n):
+                x = 0
+                total = 0
+                while n:
+                    total = total + x
+                    x = n
+                    n = n - 1
+                return total
+        """)
+        liveness = Liveness(cfg).run()
+        # x is read by the next iteration
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'x', 1),
+                         {'n', 'total', 'x'})
+
+    def test_exception_handler(self):
+        cfg = get_cfg("""
+            def func():
+                try:
+                    x = 1
+                    func()
+                    x = 2
+                    func()
+                except Exception:
+                    return x
+                x = 3
+        """)
+        liveness = Liveness(cfg).run()
+        # the handler can read the first value of x
+        self.assertIn('x', self.live_after(liveness, cfg, 'STORE_FAST', 'x'))
+        self.assertNotIn('x', self.live_after(liveness, cfg,
+                                              'STORE_FAST', 'x', 2))
+
+    def test_delete(self):
+        cfg = get_cfg("""
+            def func():
+                x = 1
+                del x
+        """)
+        liveness = Liveness(cfg).run()
+        # DELETE_FAST fails if x is unbound
+        self.assertEqual(self.live_after(liveness, cfg, 'STORE_FAST', 'x'),
+                         {'x'})
+
+
+class ReachingDefinitionsTests(TestCase):
+
+    def test_branches(self):
+        cfg = get_cfg("""
+            def func(x):
+                if x:
+                    y = 1
+                else:
+                    y = 2
+                    x = 3
+                return x + y
+        """)
+        analysis = ReachingDefinitions(cfg).run()
+        last_block = cfg[-1]
+        value = analysis.get_in(last_block)
+
+        definitions = analysis.get_definitions(value, 'y')
+        self.assertEqual([definition.instr.name for definition in definitions],
+                         ['STORE_FAST', 'STORE_FAST'])
+        self.assertEqual(sorted(definition.block[0].arg
+                                for definition in definitions),
+                         [1, 2])
+
+        # the argument value and x = 3
+        definitions = analysis.get_definitions(value, 'x')
+        self.assertEqual(len(definitions), 2)
+        self.assertEqual([definition.instr for definition in definitions
+                          if definition.instr is None], [None])
+
+        # definitions at the function entry
+        entry = analysis.get_in(cfg[0])
+        self.assertEqual([definition.name for definition
+                          in analysis.definitions.to_items(entry)],
+                         ['x', 'y'])
+        self.assertEqual(analysis.get_definitions(entry, 'z'), [])
+
+    def test_loop(self):
+        cfg = get_cfg("""
+            def func(n):
+                x = 0
+                while n:
+                    x = x + 1
+                return x
+        """)
+        analysis = ReachingDefinitions(cfg).run()
+        block, index = find_instr(cfg, 'LOAD_FAST', 'x')
+        for instr_index, instr, value in analysis.instr_values(block):
+            if instr_index == index:
+                break
+        definitions = analysis.get_definitions(value, 'x')
+        self.assertEqual(sorted(definition.instr.lineno
+                                for definition in definitions), [2, 4])
+
+
+class CustomAnalysisTests(TestCase):
+
+    def test_custom_lattice(self):
+        class CalledFunctions(DataFlowAnalysis):
+            # functions which may have been loaded before an instruction
+            def bottom(self):
+                return frozenset()
+
+            def transfer(self, instr, value):
+                if instr.name == 'LOAD_GLOBAL':
+                    value = value | {instr.arg}
+                return value
+
+        cfg = get_cfg("""
+            def func(x):
+                if x:
+                    f()
+                else:
+                    g()
+                return h()
+        """)
+        analysis = CalledFunctions(cfg).run()
+        self.assertEqual(analysis.get_in(cfg[0]), frozenset())
+        self.assertEqual(analysis.get_out(cfg[-1]), {'f', 'g', 'h'})
+
+        with self.assertRaises(ValueError):
+            analysis.get_in(ControlFlowGraph()[0])
+        with self.assertRaises(RuntimeError):
+            CalledFunctions(cfg).get_in(cfg[0])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -104,6 +104,18 @@ class InstrTests(TestCase):
         with self.assertRaises(AttributeError):
             instr.myattr = 1
 
+    def test_copy(self):
+        instr = Instr("LOAD_CONST", 3, lineno=7)
+        copy = instr.copy()
+        self.assertIsNot(copy, instr)
+        self.assertIs(type(copy), Instr)
+        self.assertEqual(copy, instr)
+        self.assertEqual(copy.opcode, opcode.opmap["LOAD_CONST"])
+
+        # the copy is independent
+        copy.arg = 5
+        self.assertEqual(instr.arg, 3)
+
     def test_compare(self):
         instr = Instr("LOAD_CONST", 3, lineno=7)
         self.assertEqual(instr, Instr("LOAD_CONST", 3, lineno=7))
@@ -140,6 +152,37 @@ class InstrTests(TestCase):
         instr = Instr("POP_JUMP_IF_TRUE", label)
         self.assertFalse(instr.is_uncond_jump())
 
+    def test_is_final(self):
+        label = Label()
+        for name, arg in (("RETURN_VALUE", UNSET),
+                          ("RAISE_VARARGS", 1),
+                          ("JUMP_FORWARD", label),
+                          ("JUMP_ABSOLUTE", label)):
+            self.assertTrue(Instr(name, arg).is_final(), name)
+
+        for name, arg in (("POP_JUMP_IF_TRUE", label),
+                          ("LOAD_FAST", 'x')):
+            self.assertFalse(Instr(name, arg).is_final(), name)
+
+    def test_opcode_flags(self):
+        # the precomputed table must be consistent with the opcode module
+        label = Label()
+        for name, op in opcode.opmap.items():
+            arg = label if op in opcode.hasjrel + opcode.hasjabs else UNSET
+            if arg is UNSET and op >= opcode.HAVE_ARGUMENT:
+                arg = 0
+            try:
+                instr = Instr(name, arg)
+            except TypeError:
+                # argument of the wrong type
+                continue
+            self.assertEqual(instr.require_arg(),
+                             op >= opcode.HAVE_ARGUMENT, name)
+            self.assertEqual(instr.has_jump(),
+                             op in opcode.hasjrel or op in opcode.hasjabs,
+                             name)
+            self.assertEqual(instr.is_cond_jump(), 'JUMP_IF_' in name, name)
+
     def test_const_key_not_equal(self):
         def check(value):
             self.assertEqual(Instr('LOAD_CONST', value),
@@ -191,6 +234,32 @@ class InstrTests(TestCase):
         self.assertNotEqual(Instr('LOAD_CONST', frozenset({0})),
                             Instr('LOAD_CONST', frozenset({0.0})))
 
+        # int and bool: 1 == True
+        self.assertNotEqual(Instr('LOAD_CONST', 1),
+                            Instr('LOAD_CONST', True))
+        self.assertNotEqual(Instr('LOAD_CONST', (1,)),
+                            Instr('LOAD_CONST', (True,)))
+
+        # str and bytes
+        self.assertNotEqual(Instr('LOAD_CONST', 'x'),
+                            Instr('LOAD_CONST', b'x'))
+
+    def test_const_key_containers(self):
+        # equal containers built separately get the same key
+        self.assertEqual(Instr('LOAD_CONST', tuple(range(1000))),
+                         Instr('LOAD_CONST', tuple(list(range(1000)))))
+        self.assertEqual(Instr('LOAD_CONST', ('a' * 1000, (1.5, None))),
+                         Instr('LOAD_CONST', ('a' * 1000, (1.5, None))))
+        self.assertEqual(Instr('LOAD_CONST', frozenset({'a', 'b'})),
+                         Instr('LOAD_CONST', frozenset(['b', 'a'])))
+
+        # items which cannot be marshalled are compared by identity
+        obj = object()
+        self.assertEqual(Instr('LOAD_CONST', (obj, 1)),
+                         Instr('LOAD_CONST', (obj, 1)))
+        self.assertNotEqual(Instr('LOAD_CONST', (obj, 1)),
+                            Instr('LOAD_CONST', (object(), 1)))
+
     def test_stack_effects(self):
         # Verify all opcodes are handled and that "jump=None" really returns
         # the max of the other cases.
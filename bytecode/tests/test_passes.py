@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import unittest
+from bytecode import Instr, ControlFlowGraph
+from bytecode.passes import PassManager
+from bytecode.tests import TestCase
+
+
+def get_cfg():
+    cfg = ControlFlowGraph()
+    block2 = cfg.add_block()
+    block3 = cfg.add_block()
+    cfg[0].extend([Instr('LOAD_NAME', 'x'),
+                   Instr('NOP'),
+                   Instr('POP_JUMP_IF_FALSE', block3)])
+    cfg[0].next_block = block2
+    block2.extend([Instr('NOP'),
+                   Instr('NOP'),
+                   Instr('LOAD_CONST', 1),
+                   Instr('STORE_NAME', 'y')])
+    block2.next_block = block3
+    block3.extend([Instr('LOAD_CONST', None),
+                   Instr('RETURN_VALUE')])
+    return cfg
+
+
+def remove_nop(cfg):
+    # remove a single NOP per call
+    for block in cfg:
+        for index, instr in enumerate(block):
+            if instr.name == 'NOP':
+                del block[index]
+                return
+
+
+class PassManagerTests(TestCase):
+
+    def test_fixed_point(self):
+        cfg = get_cfg()
+        manager = PassManager([remove_nop])
+        self.assertTrue(manager.run(cfg))
+        self.assertEqual([instr.name for instr in cfg[1]],
+                         ['LOAD_CONST', 'STORE_NAME'])
+        # 3 iterations removing a NOP, and a last one without change
+        self.assertEqual(manager.iterations, 4)
+
+        stats = manager.statistics()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0].name, 'remove_nop')
+        self.assertEqual(stats[0].runs, 4)
+        self.assertEqual(stats[0].changes, 3)
+        self.assertGreaterEqual(stats[0].time, 0.0)
+
+        manager.reset_statistics()
+        self.assertEqual(manager.statistics()[0][1:], (0, 0, 0.0))
+
+    def test_max_iterations(self):
+        def swap(cfg):
+            # never reaches a fixed point
+            block = cfg[-1]
+            block[0] = Instr('LOAD_CONST', not block[0].arg)
+
+        cfg = get_cfg()
+        manager = PassManager(max_iterations=3)
+        manager.add_pass(swap)
+        self.assertFalse(manager.run(cfg))
+        self.assertEqual(manager.iterations, 3)
+        self.assertEqual(manager.statistics()[0].runs, 3)
+
+        with self.assertRaises(ValueError):
+            PassManager(max_iterations=0)
+
+    def test_per_block(self):
+        calls = []
+
+        def visit(cfg, block):
+            calls.append(cfg.get_block_index(block))
+
+        def change_arg(cfg):
+            # modify an instruction in-place
+            instr = cfg[1][-1]
+            if instr.arg == 'y':
+                instr.arg = 'z'
+
+        cfg = get_cfg()
+        manager = PassManager()
+        manager.add_pass(visit, 'visit', per_block=True)
+        manager.add_pass(change_arg)
+        self.assertTrue(manager.run(cfg))
+        # the pass is run again on the modified block
+        self.assertEqual(calls, [0, 1, 2, 1])
+        self.assertEqual(manager.iterations, 2)
+        self.assertEqual([(stats.name, stats.runs, stats.changes)
+                          for stats in manager.statistics()],
+                         [('visit', 2, 0), ('change_arg', 2, 1)])
+
+    def test_skip_unchanged(self):
+        calls = []
+
+        def first(cfg):
+            calls.append('first')
+
+        def second(cfg):
+            calls.append('second')
+            remove_nop(cfg)
+
+        manager = PassManager([first, second])
+        manager.run(get_cfg())
+        # first is only run again if second modified the graph
+        self.assertEqual(calls, ['first', 'second'] * 4)
+
+        calls.clear()
+        manager = PassManager([second, first])
+        manager.run(get_cfg())
+        # first is not run again after the last change
+        self.assertEqual(calls, ['second', 'first'] * 3 + ['second'])
+
+    def test_result(self):
+        def no_change(cfg):
+            # the pass claims that it didn't modify the graph
+            remove_nop(cfg)
+            return 0
+
+        manager = PassManager()
+        manager.add_pass(no_change)
+        self.assertTrue(manager.run(get_cfg()))
+        self.assertEqual(manager.iterations, 1)
+        self.assertEqual(manager.statistics()[0].changes, 0)
+
+    def test_add_pass(self):
+        manager = PassManager([remove_nop])
+        manager.add_pass(remove_nop, 'remove_nop2')
+        self.assertEqual([stats.name for stats in manager.statistics()],
+                         ['remove_nop', 'remove_nop2'])
+        with self.assertRaises(ValueError):
+            manager.add_pass(remove_nop)
+
+    def test_blocks(self):
+        def split(cfg):
+            # split the first block once
+            if len(cfg) == 3:
+                cfg.split_block(cfg[0], 1)
+
+        visited = []
+
+        def visit(cfg, block):
+            visited.append(list(block))
+
+        manager = PassManager()
+        manager.add_pass(split)
+        manager.add_pass(visit, per_block=True)
+        manager.run(get_cfg())
+        # the new block is visited
+        self.assertEqual(len(visited), 4)
+        # the split block and the new block were modified
+        self.assertEqual(manager.statistics()[0].changes, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -1,4 +1,5 @@
 import sys
+import textwrap
 import unittest
 from bytecode import Label, Instr, Compare, Bytecode, ControlFlowGraph
 from bytecode import peephole_opt
@@ -817,6 +818,492 @@ class Tests(TestCase):
                    Instr('LOAD_CONST', None),
                    Instr('RETURN_VALUE'))
 
+    def test_thread_jumps(self):
+        # Retarget jumps to a chain of unconditional jumps
+        label_jump1 = Label()
+        label_jump2 = Label()
+        label_return = Label()
+        code = Bytecode([Instr('LOAD_NAME', 'test'),
+                         Instr('POP_JUMP_IF_FALSE', label_jump1),
+                         Instr('LOAD_CONST', 1),
+                         Instr('STORE_NAME', 'x'),
+                         Instr('JUMP_FORWARD', label_jump2),
+                         label_jump1,
+                         Instr('JUMP_ABSOLUTE', label_jump2),
+                         label_jump2,
+                         Instr('JUMP_FORWARD', label_return),
+                         Instr('LOAD_CONST', 2),
+                         Instr('STORE_NAME', 'x'),
+                         label_return,
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+
+        label_return = Label()
+        self.check(code,
+                   Instr('LOAD_NAME', 'test'),
+                   Instr('POP_JUMP_IF_FALSE', label_return),
+                   Instr('LOAD_CONST', 1),
+                   Instr('STORE_NAME', 'x'),
+                   label_return,
+                   Instr('LOAD_CONST', None),
+                   Instr('RETURN_VALUE'))
+
+    def test_thread_jumps_cycle(self):
+        # while 1: pass
+        cfg = ControlFlowGraph()
+        block1 = cfg.add_block()
+        block2 = cfg.add_block()
+        cfg[0].append(Instr('JUMP_ABSOLUTE', block1))
+        block1.append(Instr('JUMP_ABSOLUTE', block2))
+        block2.append(Instr('JUMP_ABSOLUTE', block1))
+
+        self.optimize_blocks(cfg)
+        self.assertEqual(len(cfg), 1)
+        self.assertIs(cfg[0][-1].arg, cfg[0])
+
+    def test_thread_jumps_relative(self):
+        # FOR_ITER cannot jump backward: the jump at the end of the loop
+        # is not threaded
+        label_loop = Label()
+        label_exit = Label()
+        label_loop2 = Label()
+        code = Bytecode([Instr('LOAD_NAME', 'x'),
+                         Instr('GET_ITER'),
+                         label_loop2,
+                         Instr('FOR_ITER', label_exit),
+                         Instr('STORE_NAME', 'y'),
+                         Instr('LOAD_NAME', 'y'),
+                         Instr('GET_ITER'),
+                         label_loop,
+                         Instr('FOR_ITER', label_loop2),
+                         Instr('STORE_NAME', 'z'),
+                         Instr('JUMP_ABSOLUTE', label_loop),
+                         label_exit,
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+        self.check_dont_optimize(code)
+
+    def test_thread_jumps_backward(self):
+        # while x:
+        #     if y:
+        #         x = 1
+        #     else:
+        #         x = 2
+        label_loop = Label()
+        label_else = Label()
+        label_end = Label()
+        label_exit = Label()
+        code = Bytecode([label_loop,
+                         Instr('LOAD_NAME', 'x'),
+                         Instr('POP_JUMP_IF_FALSE', label_exit),
+                         Instr('LOAD_NAME', 'y'),
+                         Instr('POP_JUMP_IF_FALSE', label_else),
+                         Instr('LOAD_CONST', 1),
+                         Instr('STORE_NAME', 'x'),
+                         Instr('JUMP_FORWARD', label_end),
+                         label_else,
+                         Instr('LOAD_CONST', 2),
+                         Instr('STORE_NAME', 'x'),
+                         label_end,
+                         Instr('JUMP_ABSOLUTE', label_loop),
+                         label_exit,
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+
+        # JUMP_FORWARD is replaced with a backward JUMP_ABSOLUTE
+        label_loop = Label()
+        label_else = Label()
+        label_exit = Label()
+        self.check(code,
+                   label_loop,
+                   Instr('LOAD_NAME', 'x'),
+                   Instr('POP_JUMP_IF_FALSE', label_exit),
+                   Instr('LOAD_NAME', 'y'),
+                   Instr('POP_JUMP_IF_FALSE', label_else),
+                   Instr('LOAD_CONST', 1),
+                   Instr('STORE_NAME', 'x'),
+                   Instr('JUMP_ABSOLUTE', label_loop),
+                   label_else,
+                   Instr('LOAD_CONST', 2),
+                   Instr('STORE_NAME', 'x'),
+                   Instr('JUMP_ABSOLUTE', label_loop),
+                   label_exit,
+                   Instr('LOAD_CONST', None),
+                   Instr('RETURN_VALUE'))
+
+    def test_thread_jumps_relative_forward(self):
+        # FOR_ITER is retargeted to the last forward jump of the chain
+        label_loop = Label()
+        label_jump1 = Label()
+        label_jump2 = Label()
+        code = Bytecode([Instr('LOAD_NAME', 'x'),
+                         Instr('GET_ITER'),
+                         label_loop,
+                         Instr('FOR_ITER', label_jump1),
+                         Instr('STORE_NAME', 'y'),
+                         Instr('JUMP_ABSOLUTE', label_loop),
+                         label_jump1,
+                         Instr('JUMP_FORWARD', label_jump2),
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE'),
+                         label_jump2,
+                         Instr('JUMP_ABSOLUTE', label_loop)])
+
+        cfg = self.optimize_blocks(code)
+        block = cfg[1]
+        self.assertEqual(block[0].name, 'FOR_ITER')
+        target = block[0].arg
+        self.assertEqual(len(target), 1)
+        self.assertEqual(target[0].name, 'JUMP_ABSOLUTE')
+        self.assertIs(target[0].arg, block)
+
+    def test_thread_jumps_to_return(self):
+        label_jump = Label()
+        label_return = Label()
+        code = Bytecode([Instr('LOAD_NAME', 'x'),
+                         Instr('JUMP_FORWARD', label_jump),
+                         label_return,
+                         Instr('RETURN_VALUE'),
+                         label_jump,
+                         Instr('JUMP_ABSOLUTE', label_return)])
+        self.check(code,
+                   Instr('LOAD_NAME', 'x'),
+                   Instr('RETURN_VALUE'))
+
+    def test_const_condition(self):
+        def check(value, jump, expected):
+            label_else = Label()
+            label_end = Label()
+            code = Bytecode([Instr('LOAD_CONST', value),
+                             Instr(jump, label_else),
+                             Instr('LOAD_CONST', 1),
+                             Instr('STORE_NAME', 'x'),
+                             Instr('JUMP_FORWARD', label_end),
+                             label_else,
+                             Instr('LOAD_CONST', 2),
+                             Instr('STORE_NAME', 'x'),
+                             label_end,
+                             Instr('LOAD_CONST', None),
+                             Instr('RETURN_VALUE')])
+            self.check(code,
+                       Instr('LOAD_CONST', expected),
+                       Instr('STORE_NAME', 'x'),
+                       Instr('LOAD_CONST', None),
+                       Instr('RETURN_VALUE'))
+
+        check(True, 'POP_JUMP_IF_FALSE', 1)
+        check(0, 'POP_JUMP_IF_FALSE', 2)
+        check((), 'POP_JUMP_IF_TRUE', 1)
+        check('yes', 'POP_JUMP_IF_TRUE', 2)
+
+    def test_const_condition_or_pop(self):
+        # x = 0 or y
+        label = Label()
+        code = Bytecode([Instr('LOAD_CONST', 0),
+                         Instr('JUMP_IF_TRUE_OR_POP', label),
+                         Instr('LOAD_NAME', 'y'),
+                         label,
+                         Instr('STORE_NAME', 'x')])
+        self.check(code,
+                   Instr('LOAD_NAME', 'y'),
+                   Instr('STORE_NAME', 'x'))
+
+        # x = 1 or y: the jump keeps the value
+        label = Label()
+        code = Bytecode([Instr('LOAD_CONST', 1),
+                         Instr('JUMP_IF_TRUE_OR_POP', label),
+                         Instr('LOAD_NAME', 'y'),
+                         label,
+                         Instr('STORE_NAME', 'x')])
+        self.check(code,
+                   Instr('LOAD_CONST', 1),
+                   Instr('STORE_NAME', 'x'))
+
+    def test_const_locals(self):
+        # debug = False
+        # if debug:
+        #     print("debug")
+        label = Label()
+        code = Bytecode([Instr('LOAD_CONST', False),
+                         Instr('STORE_FAST', 'debug'),
+                         Instr('LOAD_FAST', 'debug'),
+                         Instr('POP_JUMP_IF_FALSE', label),
+                         Instr('LOAD_GLOBAL', 'print'),
+                         Instr('LOAD_CONST', 'debug'),
+                         Instr('CALL_FUNCTION', 1),
+                         Instr('POP_TOP'),
+                         label,
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+        self.check(code,
+                   Instr('LOAD_CONST', False),
+                   Instr('STORE_FAST', 'debug'),
+                   Instr('LOAD_CONST', None),
+                   Instr('RETURN_VALUE'))
+
+        # x = 2; return x * 3
+        code = Bytecode([Instr('LOAD_CONST', 2),
+                         Instr('STORE_FAST', 'x'),
+                         Instr('LOAD_FAST', 'x'),
+                         Instr('LOAD_CONST', 3),
+                         Instr('BINARY_MULTIPLY'),
+                         Instr('RETURN_VALUE')])
+        self.check(code,
+                   Instr('LOAD_CONST', 2),
+                   Instr('STORE_FAST', 'x'),
+                   Instr('LOAD_CONST', 6),
+                   Instr('RETURN_VALUE'))
+
+    def test_const_locals_dont_optimize(self):
+        # the variable is modified or deleted
+        for instrs in ([Instr('LOAD_NAME', 'y'), Instr('STORE_FAST', 'x')],
+                       [Instr('DELETE_FAST', 'x')]):
+            code = Bytecode([Instr('LOAD_CONST', 2),
+                             Instr('STORE_FAST', 'x'),
+                             *instrs,
+                             Instr('LOAD_FAST', 'x'),
+                             Instr('RETURN_VALUE')])
+            self.check_dont_optimize(code)
+
+        # the variable is set in another block
+        label = Label()
+        code = Bytecode([Instr('LOAD_CONST', 2),
+                         Instr('STORE_FAST', 'x'),
+                         Instr('LOAD_NAME', 'test'),
+                         Instr('POP_JUMP_IF_FALSE', label),
+                         Instr('LOAD_NAME', 'y'),
+                         Instr('STORE_FAST', 'x'),
+                         label,
+                         Instr('LOAD_FAST', 'x'),
+                         Instr('RETURN_VALUE')])
+        self.check_dont_optimize(code)
+
+    def test_const_locals_blocks(self):
+        # size = 4
+        # if test:
+        #     func()
+        # return size * 2
+        label = Label()
+        code = Bytecode([Instr('LOAD_CONST', 4),
+                         Instr('STORE_FAST', 'size'),
+                         Instr('LOAD_FAST', 'test'),
+                         Instr('POP_JUMP_IF_FALSE', label),
+                         Instr('LOAD_GLOBAL', 'func'),
+                         Instr('CALL_FUNCTION', 0),
+                         Instr('POP_TOP'),
+                         label,
+                         Instr('LOAD_FAST', 'size'),
+                         Instr('LOAD_CONST', 2),
+                         Instr('BINARY_MULTIPLY'),
+                         Instr('RETURN_VALUE')])
+        code.argnames = ['test']
+        code.argcount = 1
+
+        label = Label()
+        self.check(code,
+                   Instr('LOAD_CONST', 4),
+                   Instr('STORE_FAST', 'size'),
+                   Instr('LOAD_FAST', 'test'),
+                   Instr('POP_JUMP_IF_FALSE', label),
+                   Instr('LOAD_GLOBAL', 'func'),
+                   Instr('CALL_FUNCTION', 0),
+                   Instr('POP_TOP'),
+                   label,
+                   Instr('LOAD_CONST', 8),
+                   Instr('RETURN_VALUE'))
+
+    def test_fixed_point(self):
+        # size = 2 * 3
+        # if test:
+        #     func()
+        # if size:
+        #     return 1
+        # return 2
+        def get_code():
+            label = Label()
+            label2 = Label()
+            code = Bytecode([Instr('LOAD_CONST', 2),
+                             Instr('LOAD_CONST', 3),
+                             Instr('BINARY_MULTIPLY'),
+                             Instr('STORE_FAST', 'size'),
+                             Instr('LOAD_FAST', 'test'),
+                             Instr('POP_JUMP_IF_FALSE', label),
+                             Instr('LOAD_GLOBAL', 'func'),
+                             Instr('CALL_FUNCTION', 0),
+                             Instr('POP_TOP'),
+                             label,
+                             Instr('LOAD_FAST', 'size'),
+                             Instr('POP_JUMP_IF_FALSE', label2),
+                             Instr('LOAD_CONST', 1),
+                             Instr('RETURN_VALUE'),
+                             label2,
+                             Instr('LOAD_CONST', 2),
+                             Instr('RETURN_VALUE')])
+            code.argnames = ['test']
+            code.argcount = 1
+            return code
+
+        # the folded constant is propagated to the next blocks and the
+        # condition is folded
+        label = Label()
+        self.check(get_code(),
+                   Instr('LOAD_CONST', 6),
+                   Instr('STORE_FAST', 'size'),
+                   Instr('LOAD_FAST', 'test'),
+                   Instr('POP_JUMP_IF_FALSE', label),
+                   Instr('LOAD_GLOBAL', 'func'),
+                   Instr('CALL_FUNCTION', 0),
+                   Instr('POP_TOP'),
+                   label,
+                   Instr('LOAD_CONST', 1),
+                   Instr('RETURN_VALUE'))
+
+        # a single iteration
+        optimizer = peephole_opt.PeepholeOptimizer()
+        optimizer.max_iterations = 1
+        cfg = ControlFlowGraph.from_bytecode(get_code())
+        optimizer.optimize_cfg(cfg)
+        self.assertEqual(optimizer.pass_manager.iterations, 1)
+        self.assertIn(Instr('LOAD_FAST', 'size'), cfg.to_bytecode())
+
+    def test_remove_empty_blocks(self):
+        cfg = ControlFlowGraph()
+        block1 = cfg.add_block()
+        block2 = cfg.add_block()
+        block3 = cfg.add_block()
+        cfg[0].extend([Instr('LOAD_NAME', 'test'),
+                       Instr('POP_JUMP_IF_FALSE', block2)])
+        cfg[0].next_block = block1
+        block1.next_block = block2
+        block2.next_block = block3
+        block3.extend([Instr('LOAD_CONST', None),
+                       Instr('RETURN_VALUE')])
+
+        self.optimize_blocks(cfg)
+        self.assertEqual(len(cfg), 2)
+        self.assertIs(cfg[0].next_block, block3)
+        self.assertIs(cfg[0][-1].arg, block3)
+
+    def test_merge_blocks(self):
+        code = Bytecode([Instr('LOAD_NAME', 'x'),
+                         Instr('STORE_NAME', 'y'),
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+        cfg = ControlFlowGraph.from_bytecode(code)
+        cfg.split_block(cfg[0], 2)
+        cfg.split_block(cfg[1], 1)
+        self.assertEqual(len(cfg), 3)
+
+        self.optimize_blocks(cfg)
+        self.assertEqual(len(cfg), 1)
+        self.assertIsNone(cfg[0].next_block)
+        self.assertEqual(cfg.to_bytecode(), code)
+
+        # a block which is a jump target is not merged
+        label = Label()
+        code = Bytecode([Instr('LOAD_NAME', 'test'),
+                         Instr('POP_JUMP_IF_FALSE', label),
+                         Instr('LOAD_NAME', 'x'),
+                         Instr('STORE_NAME', 'y'),
+                         label,
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+        cfg = ControlFlowGraph.from_bytecode(code)
+        self.optimize_blocks(cfg)
+        self.assertEqual(len(cfg), 3)
+
+    def test_jump_to_current_block(self):
+        # A jump to the block being optimized is optimized as other jumps:
+        # the block is read from the optimized instructions
+        cfg = ControlFlowGraph()
+        block1 = cfg.add_block()
+        cfg[0].append(Instr('LOAD_CONST', None))
+        cfg[0].next_block = block1
+        block1.extend([Instr('NOP'),
+                       Instr('RETURN_VALUE'),
+                       Instr('JUMP_ABSOLUTE', block1)])
+
+        peephole_opt.PeepholeOptimizer().optimize_cfg(cfg)
+        # "JUMP_ABSOLUTE block1" is replaced with "RETURN_VALUE"
+        self.assertEqual([instr.name for block in cfg for instr in block],
+                         ['LOAD_CONST', 'RETURN_VALUE', 'RETURN_VALUE'])
+
+    def test_dispatch_table(self):
+        calls = []
+
+        class Optimizer(peephole_opt.PeepholeOptimizer):
+            def eval_LOAD_NAME(self, instr):
+                calls.append(instr.arg)
+
+            def optimize_jump(self, instr):
+                calls.append(instr.name)
+                super().optimize_jump(instr)
+
+        label = Label()
+        code = Bytecode([Instr('LOAD_NAME', 'x'),
+                         Instr('POP_JUMP_IF_FALSE', label),
+                         Instr('LOAD_NAME', 'y'),
+                         Instr('JUMP_FORWARD', label),
+                         label,
+                         Instr('LOAD_CONST', None),
+                         Instr('RETURN_VALUE')])
+        cfg = ControlFlowGraph.from_bytecode(code)
+        Optimizer().optimize_cfg(cfg)
+        # the block of the removed JUMP_FORWARD is optimized again
+        self.assertEqual(calls, ['x', 'POP_JUMP_IF_FALSE', 'y', 'JUMP_FORWARD',
+                                 'y'])
+
+        # the table of the base class is not modified
+        table = peephole_opt.PeepholeOptimizer._get_dispatch_table()
+        load_name = Instr('LOAD_NAME', 'x').opcode
+        self.assertIsNone(table[load_name])
+        self.assertIsNot(Optimizer._get_dispatch_table(), table)
+
+    def test_optimize_recursive(self):
+        source = textwrap.dedent("""
+            def outer():
+                def inner():
+                    x = 1
+                    return x + 1
+                return inner
+        """)
+        code = compile(source, '<string>', 'exec')
+
+        def get_inner(code):
+            outer = code.co_consts[0]
+            return outer.co_consts[1]
+
+        optimizer = peephole_opt.PeepholeOptimizer()
+        # nested code objects are not optimized by default
+        self.assertNotIn(2, get_inner(optimizer.optimize(code)).co_consts)
+
+        new_code = optimizer.optimize(code, recursive=True)
+        self.assertIn(2, get_inner(new_code).co_consts)
+        namespace = {}
+        exec(new_code, namespace)
+        self.assertEqual(namespace['outer']()(), 2)
+
+        transformer = peephole_opt.CodeTransformer(recursive=True)
+        new_code = transformer.code_transformer(code, {})
+        self.assertIn(2, get_inner(new_code).co_consts)
+
+    def test_large_code(self):
+        # x0 = 0 + 1; x1 = 1 + 1; x2 = 2 + 1; ...
+        size = 5000
+        instrs = []
+        for index in range(size):
+            instrs.extend((Instr('LOAD_CONST', index),
+                           Instr('LOAD_CONST', 1),
+                           Instr('BINARY_ADD'),
+                           Instr('STORE_NAME', 'x%s' % index)))
+        code = Bytecode(instrs)
+
+        expected = []
+        for index in range(size):
+            expected.extend((Instr('LOAD_CONST', index + 1),
+                             Instr('STORE_NAME', 'x%s' % index)))
+        self.check(code, *expected)
+
 
 if __name__ == "__main__":
     unittest.main()